@@ -1,11 +1,27 @@
+import fcntl
+import hashlib
+import itertools
+import json
+import math
 import os
+import re
+import shutil
+import socket
 import subprocess
+import threading
+import time
 import uuid
+import numpy as np
 import requests
-from flask import Flask, request, jsonify, send_file
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import NamedTuple
+from flask import Flask, request, jsonify, send_file, url_for
 from werkzeug.utils import secure_filename
 from flask_cors import CORS
-from PIL import Image, ImageOps
+from PIL import Image, ImageOps, UnidentifiedImageError, features
 from io import BytesIO
 
 # Initialize Flask application
@@ -19,164 +35,2387 @@ UPLOAD_FOLDER = 'uploads'  # Temporary storage for downloaded audio and images
 VIDEO_FOLDER = 'videos'    # Output folder for generated videos
 ALLOWED_EXTENSIONS = {'mp3', 'wav', 'jpg', 'png', 'jpeg', 'webp'}
 
+# Video rendering settings
+IMAGE_DURATION = 3   # Seconds each image is displayed
+VIDEO_WIDTH = 720    # Output width in pixels
+VIDEO_HEIGHT = 1280  # Output height in pixels
+
+# Named H.264 encoding profiles, selected with "profile" in the /convert payload
+# preset: Balance between encoding speed and compression
+# tune: x264 tuning (stillimage suits slideshows of static pictures)
+# crf: Constant quality, lower is better quality and bigger files
+# fps: Output frame rate; a still image needs few frames, so fewer duplicate frames are encoded
+# keyint: Maximum frames between keyframes
+ENCODING_PROFILES = {
+    # General-purpose settings, as used before profiles existed
+    "standard": {"preset": "medium", "tune": None, "crf": 23, "fps": 25, "keyint": 250},
+    # Static slideshows: tuned for still images, 5 fps, a keyframe per image
+    "slideshow": {"preset": "medium", "tune": "stillimage", "crf": 23, "fps": 5, "keyint": 15},
+    # Fastest encode, slightly bigger files
+    "fast": {"preset": "veryfast", "tune": "stillimage", "crf": 23, "fps": 5, "keyint": 15},
+    # Smallest files, slowest encode (segments are cached, so it is paid once per image)
+    "small": {"preset": "slow", "tune": "stillimage", "crf": 26, "fps": 5, "keyint": 15},
+}
+DEFAULT_ENCODING_PROFILE = os.environ.get('ENCODING_PROFILE', 'slideshow')
+# Fail at startup rather than blaming every request that sets no profile
+if DEFAULT_ENCODING_PROFILE not in ENCODING_PROFILES:
+    raise ValueError(
+        f"Unknown ENCODING_PROFILE '{DEFAULT_ENCODING_PROFILE}'. Available: {', '.join(ENCODING_PROFILES)}.")
+
+# How images are fitted to the video size, selected with "fit" in the /convert payload
+# crop: Fill the frame, cutting the edges that don't fit (default)
+# letterbox: Show the whole image scaled to fit, with black bars
+# pad: Like letterbox, but images smaller than the frame are not enlarged
+FIT_MODES = ('crop', 'letterbox', 'pad')
+
+# Download concurrency limits
+# DOWNLOAD_CONCURRENCY: maximum parallel downloads for a single request
+# DOWNLOAD_GLOBAL_CONCURRENCY: maximum parallel downloads across the whole worker process
+DOWNLOAD_CONCURRENCY = int(os.environ.get('DOWNLOAD_CONCURRENCY', 8))
+DOWNLOAD_GLOBAL_CONCURRENCY = int(os.environ.get('DOWNLOAD_GLOBAL_CONCURRENCY', 16))
+
+# Download timeouts, so a slow or hung server can't hold download slots forever
+# DOWNLOAD_CONNECT_TIMEOUT: seconds to establish the connection
+# DOWNLOAD_READ_TIMEOUT: seconds to wait for the response and between received bytes
+DOWNLOAD_CONNECT_TIMEOUT = float(os.environ.get('DOWNLOAD_CONNECT_TIMEOUT', 10))
+DOWNLOAD_READ_TIMEOUT = float(os.environ.get('DOWNLOAD_READ_TIMEOUT', 30))
+DOWNLOAD_TIMEOUT = (DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)
+
+# Shared by every request handled by this worker process
+_download_slots = threading.BoundedSemaphore(DOWNLOAD_GLOBAL_CONCURRENCY)
+
+# Outbound HTTP connection pooling
+# HTTP_POOL_HOSTS: number of hosts to keep connection pools for
+# HTTP_POOL_SIZE: maximum kept-alive connections per host
+HTTP_POOL_HOSTS = int(os.environ.get('HTTP_POOL_HOSTS', 10))
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', DOWNLOAD_GLOBAL_CONCURRENCY))
+
+# On-disk download cache for source media (audio and images)
+# CACHE_FOLDER: root of all on-disk caches (inside uploads so cached files can be hard-linked)
+# MEDIA_CACHE_MAX_BYTES: byte budget of the media cache, least recently used files are evicted first
+# MEDIA_CACHE_TTL: seconds a cached URL is reused without revalidating it with the server
+CACHE_FOLDER = os.environ.get('CACHE_FOLDER', os.path.join(UPLOAD_FOLDER, '.cache'))
+MEDIA_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'media')
+MEDIA_BLOBS_FOLDER = os.path.join(MEDIA_CACHE_FOLDER, 'blobs')  # Files named by content hash
+MEDIA_URLS_FOLDER = os.path.join(MEDIA_CACHE_FOLDER, 'urls')    # URL -> content hash + validators
+MEDIA_PROBES_FOLDER = os.path.join(MEDIA_CACHE_FOLDER, 'probes')  # Content hash -> probe_media() result
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get('MEDIA_CACHE_MAX_BYTES', 1024 ** 3))
+MEDIA_CACHE_TTL = int(os.environ.get('MEDIA_CACHE_TTL', 3600))
+
+# Cache of encoded per-image video segments, reused across requests
+# SEGMENT_CACHE_MAX_BYTES: byte budget, least recently used segments are evicted first
+SEGMENT_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'segments')
+SEGMENT_CACHE_MAX_BYTES = int(os.environ.get('SEGMENT_CACHE_MAX_BYTES', 1024 ** 3))
+# Bump when a code change alters the encoded segments for the same settings
+SEGMENT_CACHE_VERSION = 3
+# Bump when a code change alters the probe_media() results
+MEDIA_PROBE_VERSION = 1
+
+# Output audio settings
+# AUDIO_BITRATE: AAC bitrate in bits/s (0 = encoder default)
+# AUDIO_SAMPLE_RATE: output sample rate in Hz (0 = same as the source)
+AUDIO_BITRATE = int(os.environ.get('AUDIO_BITRATE', 0))
+AUDIO_SAMPLE_RATE = int(os.environ.get('AUDIO_SAMPLE_RATE', 0))
+
+# EBU R128 loudness normalization, enabled with "loudness" (target in LUFS) in the /convert payload
+# LOUDNESS_RANGE: allowed targets, as accepted by ffmpeg's loudnorm filter
+# LOUDNESS_TRUE_PEAK, LOUDNESS_LRA: maximum true peak (dBTP) and loudness range (LU), loudnorm defaults
+LOUDNESS_RANGE = (-70.0, -5.0)
+LOUDNESS_TRUE_PEAK = -1.5
+LOUDNESS_LRA = 11.0
+
+# Cache of audio assets encoded to AAC, keyed by (source content, audio settings),
+# for sources that can't be copied into the MP4 as is
+# AUDIO_CACHE_MAX_BYTES: byte budget, least recently used tracks are evicted first
+AUDIO_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'audio')
+AUDIO_CACHE_MAX_BYTES = int(os.environ.get('AUDIO_CACHE_MAX_BYTES', 512 * 1024 ** 2))
+# Bump when a code change alters the transcoded audio
+AUDIO_CACHE_VERSION = 3
+# Audio codecs (as named by ffprobe) stream-copied into the output without re-encoding
+MP4_COPY_AUDIO_CODECS = {'aac'}
+
+# Cache of rendered videos, keyed by a hash of the normalized /convert request
+# OUTPUT_CACHE_MAX_BYTES: byte budget, oldest renders are evicted first (0 disables the cache)
+# OUTPUT_CACHE_MAX_AGE: seconds a rendered video is served from the cache
+OUTPUT_CACHE_FOLDER = os.path.join(VIDEO_FOLDER, '.cache')
+OUTPUT_CACHE_MAX_BYTES = int(os.environ.get('OUTPUT_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+OUTPUT_CACHE_MAX_AGE = int(os.environ.get('OUTPUT_CACHE_MAX_AGE', 7 * 24 * 3600))
+# Bump when a code change alters the rendered output for the same request
+OUTPUT_CACHE_VERSION = 6
+# Seconds the result of a render is kept for the identical requests waiting on it
+# (see render_video), whether or not the output cache is enabled
+RENDER_RESULT_MAX_AGE = 600
+
+# Asynchronous render jobs
+# JOB_FOLDER: job status records, shared by all worker processes
+# RENDER_THREADS: background render threads per worker process
+# JOB_MAX_AGE: seconds a finished job record is kept
+# JOB_HEARTBEAT_INTERVAL: seconds between heartbeats of the unfinished jobs of a process
+# JOB_HEARTBEAT_TIMEOUT: seconds without a heartbeat after which an unfinished job is reported failed
+JOB_FOLDER = os.path.join(VIDEO_FOLDER, '.jobs')
+RENDER_THREADS = int(os.environ.get('RENDER_THREADS', 4))
+JOB_MAX_AGE = int(os.environ.get('JOB_MAX_AGE', 24 * 3600))
+JOB_HEARTBEAT_INTERVAL = 10
+JOB_HEARTBEAT_TIMEOUT = int(os.environ.get('JOB_HEARTBEAT_TIMEOUT', 60))
+# Host of this process, job owner pids are only meaningful on the same host
+JOB_HOST = socket.gethostname()
+
+# Render scheduling and admission control
+# RENDER_CONCURRENCY: concurrent ffmpeg encodes across all worker processes
+# ENCODE_THREADS: threads per ffmpeg encode (defaults to sharing the CPUs between encodes)
+# RENDER_QUEUE_SIZE: queued + running renders accepted per worker process before answering 503
+# RENDER_RETRY_AFTER: seconds sent in the Retry-After header when the queue is full
+RENDER_SLOT_FOLDER = os.path.join(VIDEO_FOLDER, '.slots')
+RENDER_CONCURRENCY = int(os.environ.get('RENDER_CONCURRENCY', 2))
+# CPUs this process may run on (sched_getaffinity is Linux-only, e.g. not on macOS)
+CPU_COUNT = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+ENCODE_THREADS = int(os.environ.get('ENCODE_THREADS', max(1, CPU_COUNT // RENDER_CONCURRENCY)))
+# SEGMENT_WORKERS: image segments of one render encoded in parallel (each holds an encoder slot)
+SEGMENT_WORKERS = int(os.environ.get('SEGMENT_WORKERS', RENDER_CONCURRENCY))
+RENDER_QUEUE_SIZE = int(os.environ.get('RENDER_QUEUE_SIZE', 16))
+RENDER_RETRY_AFTER = int(os.environ.get('RENDER_RETRY_AFTER', 30))
+
+# Limits for images downloaded by /resize-image
+# RESIZE_MAX_BYTES: maximum download size of a source image
+# RESIZE_MAX_PIXELS: maximum width x height of a source image, checked from its header
+# RESIZE_MAX_OUTPUT_PIXELS: maximum width x height of a requested size
+RESIZE_MAX_BYTES = int(os.environ.get('RESIZE_MAX_BYTES', 20 * 1024 ** 2))
+RESIZE_MAX_PIXELS = int(os.environ.get('RESIZE_MAX_PIXELS', 50_000_000))
+RESIZE_MAX_OUTPUT_PIXELS = int(os.environ.get('RESIZE_MAX_OUTPUT_PIXELS', RESIZE_MAX_PIXELS))
+
+# Two-tier cache of /resize-image results: in-process LRU, then on disk
+# RESIZE_MEMORY_CACHE_MAX_BYTES: byte budget of the in-process tier, per worker process (0 disables it)
+# RESIZE_DISK_CACHE_MAX_BYTES: byte budget of the disk tier, oldest images are evicted first (0 disables it)
+# RESIZE_CACHE_MAX_AGE: seconds a resized image is reused, also sent to clients in Cache-Control
+RESIZE_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'resized')
+RESIZE_MEMORY_CACHE_MAX_BYTES = int(os.environ.get('RESIZE_MEMORY_CACHE_MAX_BYTES', 64 * 1024 ** 2))
+RESIZE_DISK_CACHE_MAX_BYTES = int(os.environ.get('RESIZE_DISK_CACHE_MAX_BYTES', 256 * 1024 ** 2))
+RESIZE_CACHE_MAX_AGE = int(os.environ.get('RESIZE_CACHE_MAX_AGE', 24 * 3600))
+
+# Maximum number of sizes in one /resize-images request
+RESIZE_BATCH_MAX_SIZES = int(os.environ.get('RESIZE_BATCH_MAX_SIZES', 20))
+
+# Output formats of /resize-image: fmt parameter -> (Pillow format, mimetype)
+# 'auto' encodes every format the client accepts and keeps the smallest result
+# RESIZE_QUALITY: default quality of lossy formats (1-95), overridden by the q parameter
+# RESIZE_WEBP_METHOD: WebP encoder effort (0 = fastest, 6 = smallest)
+RESIZE_FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+}
+if not features.check('webp'):
+    del RESIZE_FORMATS['webp']
+# Mimetype -> fmt parameter, to name the format auto picked
+RESIZE_MIMETYPE_FORMATS = {mimetype: fmt for fmt, (_, mimetype) in RESIZE_FORMATS.items()}
+RESIZE_QUALITY = int(os.environ.get('RESIZE_QUALITY', 82))
+RESIZE_WEBP_METHOD = int(os.environ.get('RESIZE_WEBP_METHOD', 4))
+
 # Make sure the folders exist, create them if they don't
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(VIDEO_FOLDER, exist_ok=True)
+os.makedirs(MEDIA_BLOBS_FOLDER, exist_ok=True)
+os.makedirs(MEDIA_URLS_FOLDER, exist_ok=True)
+os.makedirs(MEDIA_PROBES_FOLDER, exist_ok=True)
+os.makedirs(SEGMENT_CACHE_FOLDER, exist_ok=True)
+os.makedirs(AUDIO_CACHE_FOLDER, exist_ok=True)
+os.makedirs(OUTPUT_CACHE_FOLDER, exist_ok=True)
+os.makedirs(RESIZE_CACHE_FOLDER, exist_ok=True)
+os.makedirs(JOB_FOLDER, exist_ok=True)
+os.makedirs(RENDER_SLOT_FOLDER, exist_ok=True)
 
 # Configure the Flask app with upload folder path
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
 
-def resize_image_exact(image_url: str, new_width: int, new_height: int, output_filename: str = "resized_exact.jpg") -> str | None:
+# Shared HTTP session of the current process (see get_http_session)
+_http_session = None
+_http_session_pid = None
+_http_session_lock = threading.Lock()
+
+
+# Function to get the connection-pooled HTTP session for outbound fetches
+def get_http_session():
+    """
+    Return the HTTP session shared by every outbound fetch in this process.
+    The session keeps connections alive and pools them per host, so repeated
+    downloads from the same CDN reuse the TCP+TLS connection.
+    A new session is created after a fork so gunicorn workers never share sockets.
+    
+    Returns:
+        requests.Session: The pooled session
+    """
+    global _http_session, _http_session_pid
+    with _http_session_lock:
+        if _http_session is None or _http_session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+            _http_session_pid = os.getpid()
+        return _http_session
+
+
+# Function to hold an exclusive lock shared by all worker processes
+@contextmanager
+def file_lock(lock_path, blocking=True):
+    """
+    Hold an exclusive flock() on lock_path for the duration of the block.
+    The lock is shared by all gunicorn workers in the container.
+    
+    Args:
+        lock_path: Path of the lock file (created if missing)
+        blocking: Wait for the lock if True, give up immediately if False
+        
+    Yields:
+        bool: True if the lock is held, False if it was busy (non-blocking only)
+    """
+    with open(lock_path, 'a') as lock_file:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# Function to hash a string (URLs, cache keys)
+def sha256_text(text):
+    """
+    Return the hex SHA-256 digest of a string.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+# Function to read a small JSON metadata file
+def read_json(path):
+    """
+    Read a JSON file.
+    
+    Returns:
+        The decoded data, or None if the file is missing or corrupt
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# Function to write a small JSON metadata file atomically
+def write_json_atomic(path, data):
+    """
+    Write data as JSON so other processes never see a partially written file.
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+# Function to place a cached file at a new path without copying data when possible
+def link_or_copy(src, dst):
+    """
+    Hard-link src to dst, falling back to a copy across filesystems.
+    Deleting either path later never affects the other one.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+# Function to evict least recently used files from a cache folder
+def evict_lru(folder, max_bytes, max_age=None):
+    """
+    Delete the least recently used files in folder until it fits in max_bytes.
+    The modification time of a cached file is its last use time.
+    Files starting with '.' (locks, partial downloads) are ignored.
+    
+    Args:
+        folder: Cache folder to trim
+        max_bytes: Byte budget for the folder
+        max_age: Optional age in seconds after which files are always removed
+        
+    Returns:
+        int: Number of files removed
+    """
+    entries = []
+    for entry in os.scandir(folder):
+        if entry.name.startswith('.') or not entry.is_file():
+            continue
+        stat = entry.stat()
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    expired_before = time.time() - max_age if max_age is not None else None
+    removed = 0
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes and (expired_before is None or mtime >= expired_before):
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        total -= size
+    return removed
+
+
+# Function to let the JPEG decoder downscale large images while decoding
+def draft_for_size(img, size):
+    """
+    Configure reduced-resolution decoding for an image that will be fitted to size.
+    JPEG images much larger than the target are decoded at 1/2, 1/4 or 1/8 scale,
+    which cuts decode time and memory; the final resize still uses LANCZOS.
+    The image is kept at least twice the size that fit_image needs, so quality
+    is unchanged. No effect on other formats or already loaded images.
+    
+    Args:
+        img: Pillow image, opened but not loaded yet
+        size: Target (width, height)
+    """
+    scale = max(size[0] / img.width, size[1] / img.height)
+    if scale < 0.5:
+        img.draft(None, (math.ceil(img.width * scale * 2), math.ceil(img.height * scale * 2)))
+
+
+# Function to crop and resize an image so it exactly fills a target size
+def fit_image(img, size):
+    """
+    Resize an image to exactly size, cropping the center instead of
+    distorting it when the aspect ratios differ (like ImageOps.fit).
+    
+    Args:
+        img: Pillow image
+        size: Target (width, height)
+        
+    Returns:
+        Image: The fitted image
+    """
+    # Centered crop box with the aspect ratio of the target
+    target_ratio = size[0] / size[1]
+    if img.width / img.height > target_ratio:
+        crop_width, crop_height = img.height * target_ratio, img.height
+    else:
+        crop_width, crop_height = img.width, img.width / target_ratio
+    left = (img.width - crop_width) / 2
+    top = (img.height - crop_height) / 2
+
+    # Use Image.Resampling.LANCZOS for high-quality resampling, especially for downscaling
+    # reducing_gap shrinks big images with the fast reduce() first, then finishes with LANCZOS
+    return img.resize(
+        size,
+        Image.Resampling.LANCZOS,
+        box=(left, top, left + crop_width, top + crop_height),
+        reducing_gap=2.0
+    )
+
+
+# Function to decode an image as an RGB frame of the video size
+def fit_frame(image_path, size, fit='crop'):
+    """
+    Decode an image, apply its EXIF orientation and fit it to the video size.
+    Transparent areas and the bars of letterbox/pad are black.
+
+    Args:
+        image_path: Path of the source image
+        size: Video (width, height)
+        fit: One of FIT_MODES
+
+    Returns:
+        numpy.ndarray: (height, width, 3) uint8 RGB frame
+    """
+    with Image.open(image_path) as img:
+        # Orientations 5-8 swap width and height, so draft for the rotated size
+        orientation = img.getexif().get(0x0112, 1)
+        draft_for_size(img, size[::-1] if orientation in (5, 6, 7, 8) else size)
+        img = ImageOps.exif_transpose(img)
+        # Palette, CMYK and 16-bit images can't be resampled with LANCZOS as-is
+        if img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            img = img.convert('RGBA' if has_alpha(img) else 'RGB')
+
+        if fit == 'crop':
+            img = fit_image(img, size)
+        else:
+            scale = min(size[0] / img.width, size[1] / img.height)
+            if fit == 'pad':
+                scale = min(scale, 1.0)
+            inner_size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            if inner_size != img.size:
+                img = img.resize(inner_size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+        pixels = np.asarray(img)
+
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, np.newaxis]
+    if pixels.shape[2] in (2, 4):
+        # LA / RGBA: blend over the black background
+        alpha = pixels[:, :, -1:].astype(np.uint16)
+        pixels = ((pixels[:, :, :-1] * alpha + 127) // 255).astype(np.uint8)
+
+    # Center on a black canvas (gray images are broadcast to the 3 channels)
+    frame = np.zeros((size[1], size[0], 3), np.uint8)
+    height, width = pixels.shape[:2]
+    top, left = (size[1] - height) // 2, (size[0] - width) // 2
+    frame[top:top + height, left:left + width] = pixels
+    return frame
+
+
+# Function to convert an RGB frame to raw yuv420p
+def rgb_to_yuv420p(frame):
+    """
+    Convert an RGB frame to planar yuv420p with vectorized integer math,
+    using the BT.601 limited-range coefficients of ffmpeg's default RGB
+    conversion, so the encoder takes the frame without any conversion.
+
+    Args:
+        frame: (height, width, 3) uint8 RGB frame with even width and height
+
+    Returns:
+        numpy.ndarray: 1-D uint8 array, the Y plane followed by the U and V planes
+    """
+    height, width = frame.shape[:2]
+    rgb = frame.astype(np.int32)
+    r, g, b = rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2]
+    y = ((66 * r + 129 * g + 25 * b + 128) >> 8) + 16
+
+    # Chroma of each 2x2 block, from the sums of its 4 pixels
+    blocks = rgb.reshape(height // 2, 2, width // 2, 2, 3).sum(axis=(1, 3))
+    r, g, b = blocks[:, :, 0], blocks[:, :, 1], blocks[:, :, 2]
+    u = ((-38 * r - 74 * g + 112 * b + 512) >> 10) + 128
+    v = ((112 * r - 94 * g - 18 * b + 512) >> 10) + 128
+    return np.concatenate([y.ravel(), u.ravel(), v.ravel()]).astype(np.uint8)
+
+
+# Function to prepare the raw video frames of a batch of images
+def prepare_frames(image_paths, size, fit='crop'):
+    """
+    Decode and fit a batch of images into raw yuv420p video frames.
+    Images are processed on ENCODE_THREADS threads (Pillow and NumPy
+    release the GIL), each written straight into its row of one array.
+
+    Args:
+        image_paths: Paths of the source images
+        size: Video (width, height)
+        fit: One of FIT_MODES
+
+    Returns:
+        numpy.ndarray: (len(image_paths), width * height * 3 / 2) uint8 frames
+    """
+    frames = np.empty((len(image_paths), size[0] * size[1] * 3 // 2), np.uint8)
+
+    def prepare(index):
+        frames[index] = rgb_to_yuv420p(fit_frame(image_paths[index], size, fit))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(ENCODE_THREADS, len(image_paths)))) as executor:
+        list(executor.map(prepare, range(len(image_paths))))
+    return frames
+
+
+# Error raised when a source image exceeds the download limits
+class ImageTooLargeError(Exception):
+    """
+    Error raised when an image exceeds RESIZE_MAX_BYTES or RESIZE_MAX_PIXELS.
+    """
+
+
+# Function to check the dimensions of a partially downloaded image
+def _check_image_header(buffer, max_pixels):
+    """
+    Try to read the image dimensions from the bytes downloaded so far.
+    
+    Args:
+        buffer: BytesIO with the beginning of the image
+        max_pixels: Maximum allowed width x height
+        
+    Returns:
+        bool: True if the dimensions were read, False if the header is incomplete
+        
+    Raises:
+        ImageTooLargeError: If the image has too many pixels
+    """
+    position = buffer.tell()
+    buffer.seek(0)
+    try:
+        # Image.open only parses the header, the pixels are not decoded
+        with Image.open(buffer) as img:
+            width, height = img.size
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e))
+    except Exception:
+        return False
+    finally:
+        buffer.seek(position)
+    if width * height > max_pixels:
+        raise ImageTooLargeError(f"Image is {width}x{height}, more than {max_pixels} pixels.")
+    return True
+
+
+# Function to download an image with size limits
+def fetch_image(url, max_bytes=RESIZE_MAX_BYTES, max_pixels=RESIZE_MAX_PIXELS):
+    """
+    Stream an image into memory, rejecting it as early as possible when it is too large:
+    from Content-Length before downloading, from its header dimensions
+    after the first chunks, and from the byte count while downloading.
+    
+    Args:
+        url: URL of the image
+        max_bytes: Maximum download size in bytes
+        max_pixels: Maximum width x height
+        
+    Returns:
+        Image: Opened (not yet decoded) Pillow image
+        
+    Raises:
+        ImageTooLargeError: If a limit is exceeded
+        requests.exceptions.RequestException: If the download fails
+    """
+    buffer = BytesIO()
+    header_checked = False
+    with get_http_session().get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status() # Check for HTTP errors
+        content_length = response.headers.get('Content-Length', '')
+        if content_length.isdigit() and int(content_length) > max_bytes:
+            raise ImageTooLargeError(f"Image is {content_length} bytes, more than {max_bytes} bytes.")
+
+        for chunk in response.iter_content(64 * 1024):
+            buffer.write(chunk)
+            if buffer.tell() > max_bytes:
+                raise ImageTooLargeError(f"Image is more than {max_bytes} bytes.")
+            # The header is within the first bytes of any supported format
+            if not header_checked and buffer.tell() <= 1024 * 1024:
+                header_checked = _check_image_header(buffer, max_pixels)
+
+    buffer.seek(0)
+    if not header_checked:
+        _check_image_header(buffer, max_pixels)
+    return Image.open(buffer)
+
+
+# Function to pick the candidate output formats of a resize request
+def negotiate_formats(fmt, accept):
+    """
+    Resolve the fmt parameter and the Accept header to candidate output formats.
+
+    Args:
+        fmt: Requested format ('jpeg', 'png', 'webp' or 'auto')
+        accept: werkzeug MIMEAccept of the request
+
+    Returns:
+        tuple: Candidate keys of RESIZE_FORMATS, or None if fmt is not supported
+    """
+    if fmt != 'auto':
+        return (fmt,) if fmt in RESIZE_FORMATS else None
+    # JPEG and PNG are understood by every client, WebP only when listed explicitly
+    # (a bare */* comes from clients that may not decode it)
+    formats = ('jpeg', 'png')
+    if 'webp' in RESIZE_FORMATS and any(value == 'image/webp' and quality > 0 for value, quality in accept):
+        formats = ('webp',) + formats
+    return formats
+
+
+# Function to check whether an image has an alpha channel or a transparent palette entry
+def has_alpha(img):
+    return img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+
+
+# Source formats that usually hold graphics rather than photos
+LOSSLESS_SOURCE_FORMATS = {'PNG', 'GIF', 'BMP', 'TIFF'}
+
+
+# Function to encode a resized image in the smallest candidate format
+def encode_image(img, formats, quality=RESIZE_QUALITY, lossless_source=False):
+    """
+    Encode an image in each candidate format and keep the smallest result.
+    JPEGs are progressive with optimized Huffman tables, PNGs use optimize.
+    With several candidates, JPEG is skipped for images with transparency,
+    and PNG is only tried for transparent images or lossless sources:
+    for photos it is always far bigger, and optimizing it is slow.
+
+    Args:
+        img: Pillow image in RGB, RGBA, L or LA mode
+        formats: Candidate keys of RESIZE_FORMATS
+        quality: Quality of lossy formats (1-95)
+        lossless_source: Whether the source image was in a LOSSLESS_SOURCE_FORMATS format
+
+    Returns:
+        tuple: (encoded image bytes, mimetype)
+    """
+    if len(formats) > 1:
+        if has_alpha(img):
+            formats = [fmt for fmt in formats if fmt != 'jpeg']
+        elif not lossless_source:
+            formats = [fmt for fmt in formats if fmt != 'png']
+
+    best = None
+    for fmt in formats:
+        pillow_format, mimetype = RESIZE_FORMATS[fmt]
+        output = BytesIO()
+        if pillow_format == 'JPEG':
+            frame = img if img.mode in ('RGB', 'L') else img.convert('RGB')
+            frame.save(output, format='JPEG', quality=quality, optimize=True, progressive=True)
+        elif pillow_format == 'WEBP':
+            img.save(output, format='WEBP', quality=quality, method=RESIZE_WEBP_METHOD)
+        else:
+            img.save(output, format=pillow_format, optimize=True)
+        if best is None or output.tell() < len(best[0]):
+            best = (output.getvalue(), mimetype)
+    return best
+
+
+def resize_image_exact(
+    image_url: str,
+    new_width: int,
+    new_height: int,
+    formats: tuple[str, ...] = ('jpeg', 'png'),
+    quality: int = RESIZE_QUALITY
+) -> tuple[bytes, str] | None:
+    """
+    Downloads an image from a URL and resizes it to the exact new_width and new_height,
+    cropping the center to keep the aspect ratio. The result is encoded in memory.
+
+    :param image_url: The URL of the input image.
+    :param new_width: The desired new width in pixels.
+    :param new_height: The desired new height in pixels.
+    :param formats: Candidate output formats (keys of RESIZE_FORMATS), the smallest result wins.
+    :param quality: Quality of lossy output formats.
+    :return: (encoded image bytes, mimetype) or None if an error occurs.
+    :raises ImageTooLargeError: If the image exceeds RESIZE_MAX_BYTES or RESIZE_MAX_PIXELS.
+    :raises UnidentifiedImageError: If the URL does not point to an image Pillow can read.
+    """
+    variants = resize_image_variants(image_url, [(new_width, new_height)], formats, quality)
+    return variants[0] if variants else None
+
+
+def resize_image_variants(
+    image_url: str,
+    sizes: list[tuple[int, int]],
+    formats: tuple[str, ...] = ('jpeg', 'png'),
+    quality: int = RESIZE_QUALITY
+) -> list[tuple[bytes, str]] | None:
+    """
+    Downloads an image from a URL once and resizes it to each of the given sizes,
+    cropping the center to keep the aspect ratio. The results are encoded in memory.
+
+    :param image_url: The URL of the input image.
+    :param sizes: The desired (width, height) pairs in pixels.
+    :param formats: Candidate output formats (keys of RESIZE_FORMATS), the smallest result wins.
+    :param quality: Quality of lossy output formats.
+    :return: One (encoded image bytes, mimetype) per size, in order, or None if an error occurs.
+    :raises ImageTooLargeError: If the image exceeds RESIZE_MAX_BYTES or RESIZE_MAX_PIXELS.
+    :raises UnidentifiedImageError: If the URL does not point to an image Pillow can read.
+    """
+
+    try:
+        # 1. Download the image data (streamed, with size limits)
+        # 2. Open the image using Pillow from the downloaded bytes
+        img = fetch_image(image_url)
+
+        # 3. Decode once, large JPEGs directly at a resolution that still suits the largest size
+        original_size = img.size
+        lossless_source = img.format in LOSSLESS_SOURCE_FORMATS
+        draft_for_size(img, (max(w for w, _ in sizes), max(h for _, h in sizes)))
+        img.load()
+        # Palette and CMYK images can't be resampled with LANCZOS as-is
+        if img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            img = img.convert('RGBA' if has_alpha(img) else 'RGB')
+
+        variants = []
+        for new_size in sizes:
+            # 4. Resize the image to the exact dimensions
+            cropped_and_resized_img = fit_image(img, new_size)
+
+            # 5. Encode the resized image into a memory buffer, in the smallest candidate format
+            variants.append(encode_image(cropped_and_resized_img, formats, quality, lossless_source))
+
+            print(f"Image successfully resized: {image_url}")
+            print(f"Original size: {original_size}, New size: {cropped_and_resized_img.size}")
+
+        return variants
+
+    except ImageTooLargeError:
+        raise  # Reported to the client as 413
+    except UnidentifiedImageError:
+        raise  # Reported to the client as 400
+    except requests.exceptions.RequestException as e:
+        print(f"Error downloading image: {e}")
+        return None
+    except Exception as e:
+        print(f"Error processing image: {e}")
+        return None
+
+
+# Least recently used cache of small byte strings kept in memory
+class MemoryLRUCache:
+    """
+    Thread-safe in-process LRU cache with a byte budget and a maximum entry age.
+    Each gunicorn worker process has its own copy.
+    """
+
+    def __init__(self, max_bytes, max_age):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._entries = OrderedDict()  # key -> (stored_at, size, value)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached value, or None if missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, size, value = entry
+            if time.time() - stored_at > self.max_age:
+                del self._entries[key]
+                self._size -= size
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, size):
+        """
+        Store a value of the given size in bytes, evicting least recently used entries.
+        """
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            self._entries[key] = (time.time(), size, value)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+
+# In-process tier of the /resize-image cache
+_resized_memory_cache = MemoryLRUCache(RESIZE_MEMORY_CACHE_MAX_BYTES, RESIZE_CACHE_MAX_AGE)
+
+
+# Function to compute the cache key of a resized image
+def resize_cache_key(image_url, width, height, output_format=None, quality=None):
+    """
+    Return the cache key of a /resize-image result.
+    
+    Args:
+        image_url: URL of the source image
+        width: Target width
+        height: Target height
+        output_format: Output format, None for the source format
+        quality: Encoder quality, None for the default
+    """
+    return sha256_text(json.dumps([image_url, width, height, output_format, quality]))
+
+
+# Function to look up a resized image in the two-tier cache
+def get_cached_resized(cache_key):
+    """
+    Look up a resized image in memory first, then on disk.
+    Disk hits are promoted to the memory tier.
+    
+    Returns:
+        tuple: (image bytes, mimetype, etag), or None on a cache miss
+    """
+    result = _resized_memory_cache.get(cache_key)
+    if result or RESIZE_DISK_CACHE_MAX_BYTES <= 0:
+        return result
+
+    path = os.path.join(RESIZE_CACHE_FOLDER, cache_key)
+    try:
+        # Disk entries keep their creation time, so the age limit applies to them too
+        if time.time() - os.path.getmtime(path) > RESIZE_CACHE_MAX_AGE:
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    # The format is read back from the image header
+    with Image.open(BytesIO(data)) as img:
+        mimetype = img.get_format_mimetype() or 'application/octet-stream'
+    result = (data, mimetype, hashlib.sha256(data).hexdigest())
+    _resized_memory_cache.put(cache_key, result, len(data))
+    return result
+
+
+# Function to add a resized image to the two-tier cache
+def store_resized(cache_key, data, mimetype):
+    """
+    Add a resized image to both cache tiers and trim the disk tier to its byte budget.
+    
+    Returns:
+        tuple: (image bytes, mimetype, etag) as returned by get_cached_resized
+    """
+    # Strong ETag: identical bytes always get the same tag, whatever their URL
+    result = (data, mimetype, hashlib.sha256(data).hexdigest())
+    if RESIZE_MEMORY_CACHE_MAX_BYTES > 0:
+        _resized_memory_cache.put(cache_key, result, len(data))
+
+    if RESIZE_DISK_CACHE_MAX_BYTES > 0:
+        tmp_path = os.path.join(RESIZE_CACHE_FOLDER, f".{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(RESIZE_CACHE_FOLDER, cache_key))
+        with file_lock(os.path.join(RESIZE_CACHE_FOLDER, '.lock'), blocking=False) as locked:
+            if locked:
+                evict_lru(RESIZE_CACHE_FOLDER, RESIZE_DISK_CACHE_MAX_BYTES, RESIZE_CACHE_MAX_AGE)
+    return result
+
+
+# Function to check if file extension is allowed
+def allowed_file(filename):
+    """
+    Check if the file has an allowed extension.
+    
+    Args:
+        filename: Name of the file to check
+        
+    Returns:
+        Boolean: True if extension is allowed, False otherwise
+    """
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+# MPEG audio frame header tables, indexed by the header fields
+# Bitrates in kbit/s by (MPEG-1?, layer), index 0 is "free format" (not supported)
+MP3_BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Sample rates by version bits (0 = MPEG-2.5, 2 = MPEG-2, 3 = MPEG-1)
+MP3_SAMPLE_RATES = {0: (11025, 12000, 8000), 2: (22050, 24000, 16000), 3: (44100, 48000, 32000)}
+# Frames in a row with the same bitrate after which a header-less MP3 is taken for constant bitrate
+MP3_CBR_FRAMES = 64
+
+
+# Function to decode an MPEG audio frame header
+def parse_mp3_frame_header(header):
+    """
+    Decode the 4-byte header of an MPEG audio frame.
+
+    Args:
+        header: 4 bytes starting with the frame sync
+
+    Returns:
+        tuple: (frame length in bytes, samples per frame, sample rate, MPEG-1?, mono?, bitrate),
+               or None if the bytes are not a valid frame header
+    """
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = (header[1] >> 3) & 3
+    layer = 4 - ((header[1] >> 1) & 3)
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 3
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = MP3_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+    padding = (header[2] >> 1) & 1
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if mpeg1 or layer == 2 else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+    return length, samples, sample_rate, mpeg1, header[3] >> 6 == 3, bitrate
+
+
+# Metadata of a media file
+class MediaInfo(NamedTuple):
+    """
+    Typed result of probe_media(). Audio fields describe the first audio
+    stream and are None when the file has no audio or the value is unknown.
+    """
+    format_name: str            # Container, as named by ffprobe ('mp3', 'wav', 'mov,mp4,m4a,3gp,3g2,mj2', ...)
+    duration: float             # Seconds
+    codec: str | None           # Audio codec, as named by ffprobe ('mp3', 'aac', 'pcm_s16le', ...)
+    sample_rate: int | None     # Hz
+    channels: int | None
+    bit_rate: int | None        # Bits per second
+
+
+# Function to read the metadata of an MP3 file from its headers
+def mp3_info(audio_path):
+    """
+    Read the metadata of an MP3 file without decoding it.
+    The duration comes from the frame count of the Xing/Info (LAME) or VBRI
+    header of the first frame, minus the encoder delay and padding recorded
+    by LAME. Without such a header, the frame headers are read one by one:
+    all of them for variable bitrate files, and only the first MP3_CBR_FRAMES
+    for constant bitrate ones, whose remaining duration follows from the file
+    size (as ffprobe estimates it).
+
+    Args:
+        audio_path: Path to the audio file
+
+    Returns:
+        MediaInfo: The metadata, or None if the file is not MPEG audio
+    """
+    file_size = os.path.getsize(audio_path)
+    with open(audio_path, 'rb') as f:
+        # Skip ID3v2 tags (10-byte header, syncsafe size, optional 10-byte footer)
+        offset = 0
+        while True:
+            f.seek(offset)
+            tag = f.read(10)
+            if len(tag) < 10 or tag[:3] != b'ID3':
+                break
+            size = (tag[6] & 0x7F) << 21 | (tag[7] & 0x7F) << 14 | (tag[8] & 0x7F) << 7 | (tag[9] & 0x7F)
+            offset += 10 + size + (10 if tag[5] & 0x10 else 0)
+        f.seek(offset)
+        data = f.read(65536)
+
+        # First frame: a valid header followed by another valid header.
+        # Without ID3 tag the file must start with it, so that other formats
+        # are not mistaken for MP3; after a tag, some padding is skipped
+        position = 0
+        while True:
+            frame = parse_mp3_frame_header(data[position:position + 4])
+            if frame and (position + frame[0] + 4 > len(data)
+                          or parse_mp3_frame_header(data[position + frame[0]:position + frame[0] + 4])):
+                break
+            position = data.find(b'\xff', position + 1) if offset else -1
+            if position == -1:
+                return None
+        _, samples, sample_rate, mpeg1, mono, _ = frame
+
+        # Xing/Info header, after the side information of the first frame
+        # (the length checks guard against files truncated inside the headers)
+        xing = position + 4 + ((17 if mono else 32) if mpeg1 else (9 if mono else 17))
+        vbri = position + 36
+        if data[xing:xing + 4] in (b'Xing', b'Info') and len(data) >= xing + 12 and data[xing + 7] & 1:
+            total = int.from_bytes(data[xing + 8:xing + 12], 'big') * samples
+            # LAME tag after the 120-byte Xing header: 12-bit encoder delay and padding
+            if data[xing + 120:xing + 124] == b'LAME' and len(data) >= xing + 144:
+                delays = int.from_bytes(data[xing + 141:xing + 144], 'big')
+                total = max(0, total - (delays >> 12) - (delays & 0xFFF))
+
+        # VBRI header, 32 bytes after the first frame header
+        elif data[vbri:vbri + 4] == b'VBRI' and len(data) >= vbri + 18:
+            total = int.from_bytes(data[vbri + 14:vbri + 18], 'big') * samples
+
+        # No header: walk the frames, reading only their 4-byte headers
+        # (an ID3v1 or APE tag at the end just fails to parse)
+        else:
+            position += offset
+            total = 0
+            bitrates = set()
+            for count in itertools.count(1):
+                f.seek(position)
+                frame = parse_mp3_frame_header(f.read(4))
+                if not frame or position + frame[0] > file_size:
+                    break
+                total += frame[1]
+                position += frame[0]
+                bitrates.add(frame[5])
+                if count == MP3_CBR_FRAMES and len(bitrates) == 1:
+                    # Constant bitrate: the rest of the file, up to an ID3v1 tag, is audio
+                    f.seek(max(0, file_size - 128))
+                    end = file_size - 128 if f.read(3) == b'TAG' else file_size
+                    total += max(0, end - position) * 8 * frame[2] / frame[5]
+                    break
+
+    duration = total / sample_rate
+    return MediaInfo(
+        format_name='mp3',
+        duration=duration,
+        codec='mp3',
+        sample_rate=sample_rate,
+        channels=1 if mono else 2,
+        bit_rate=round((file_size - offset) * 8 / duration) if duration else None,
+    )
+
+
+# WAV format tags (and bits per sample) -> ffprobe codec names
+WAV_CODECS = {
+    (1, 8): 'pcm_u8', (1, 16): 'pcm_s16le', (1, 24): 'pcm_s24le', (1, 32): 'pcm_s32le',
+    (3, 32): 'pcm_f32le', (3, 64): 'pcm_f64le', (6, 8): 'pcm_alaw', (7, 8): 'pcm_mulaw',
+}
+
+
+# Function to read the metadata of a WAV file from its headers
+def wav_info(audio_path):
+    """
+    Read the metadata of a WAV (RIFF/WAVE) file from its fmt and data chunks.
+
+    Args:
+        audio_path: Path to the audio file
+
+    Returns:
+        MediaInfo: The metadata, or None if the file is not a PCM WAV file
+    """
+    file_size = os.path.getsize(audio_path)
+    with open(audio_path, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            return None
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                return None
+            chunk_id, chunk_size = chunk[:4], int.from_bytes(chunk[4:], 'little')
+            if chunk_id == b'fmt ':
+                fmt = f.read(chunk_size)
+                chunk_size = 0
+            elif chunk_id == b'data':
+                break
+            # Chunks are padded to an even size
+            f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+        # Streamed files may leave the size unset (0 or 0xFFFFFFFF)
+        data_size = min(chunk_size or file_size, file_size - f.tell())
+
+    if not fmt or len(fmt) < 16:
+        return None
+    format_tag = int.from_bytes(fmt[0:2], 'little')
+    if format_tag == 0xFFFE and len(fmt) >= 26:
+        # WAVE_FORMAT_EXTENSIBLE: the real format tag starts the sub-format GUID
+        format_tag = int.from_bytes(fmt[24:26], 'little')
+    codec = WAV_CODECS.get((format_tag, int.from_bytes(fmt[14:16], 'little')))
+    byte_rate = int.from_bytes(fmt[8:12], 'little')
+    if not codec or not byte_rate:
+        return None  # Compressed WAV, left to ffprobe
+    return MediaInfo(
+        format_name='wav',
+        duration=data_size / byte_rate,
+        codec=codec,
+        sample_rate=int.from_bytes(fmt[4:8], 'little'),
+        channels=int.from_bytes(fmt[2:4], 'little'),
+        bit_rate=byte_rate * 8,
+    )
+
+
+# Function to read the metadata of any media file with ffprobe
+def ffprobe_info(media_path):
+    """
+    Read the metadata of a media file from ffprobe's JSON output.
+
+    Args:
+        media_path: Path to the media file
+
+    Returns:
+        MediaInfo: The metadata, or None if ffprobe can't read the file
+    """
+    cmd = [
+        'ffprobe', '-v', 'error', '-print_format', 'json',
+        '-show_format', '-show_streams', media_path
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        print(f"Error probing media: {result.stderr.strip()}")
+        return None
+
+    probe = json.loads(result.stdout)
+    container = probe.get('format', {})
+    audio = next((stream for stream in probe.get('streams', []) if stream.get('codec_type') == 'audio'), {})
+
+    # ffprobe reports numbers as strings, and leaves out what it doesn't know
+    def number(value, kind=int):
+        try:
+            return kind(value)
+        except (TypeError, ValueError):
+            return None
+
+    return MediaInfo(
+        format_name=container.get('format_name', ''),
+        duration=number(container.get('duration') or audio.get('duration'), float) or 0.0,
+        codec=audio.get('codec_name'),
+        sample_rate=number(audio.get('sample_rate')),
+        channels=number(audio.get('channels')),
+        bit_rate=number(audio.get('bit_rate') or container.get('bit_rate')),
+    )
+
+
+# Function to read the metadata of a media file
+def read_media_info(media_path):
+    """
+    Read the metadata of a media file. MP3 and PCM WAV files are parsed in
+    Python, which takes well under a millisecond for files with a Xing/VBRI
+    header; other formats, and files whose headers can't be parsed, are
+    probed with ffprobe.
+
+    Args:
+        media_path: Path to the media file
+
+    Returns:
+        MediaInfo: The metadata, or None if the file can't be read
+    """
+    try:
+        info = wav_info(media_path) or mp3_info(media_path)
+    except OSError as e:
+        print(f"Error reading media file: {e}")
+        return None
+    except (IndexError, ValueError) as e:
+        print(f"Error parsing media headers, probing with ffprobe: {e}")
+        info = None
+    return info or ffprobe_info(media_path)
+
+
+# Metadata of recently probed files in this process, by content hash
+_media_info_cache = MemoryLRUCache(1024 ** 2, float('inf'))
+
+
+# Function to get the metadata of a media file, cached by content hash
+def probe_media(media_path, sha256=None):
+    """
+    Get the metadata of a media file. Results are cached by content hash in
+    memory and on disk (next to the media cache), so the same content is
+    probed only once, whatever URL it came from.
+
+    Args:
+        media_path: Path to the media file
+        sha256: SHA-256 of the file content, computed if not given
+
+    Returns:
+        MediaInfo: The metadata, or None if the file can't be read
+    """
+    if sha256 is None:
+        sha256 = file_sha256(media_path)
+    info = _media_info_cache.get(sha256)
+    if info:
+        return info
+
+    probe_path = os.path.join(MEDIA_PROBES_FOLDER, sha256 + '.json')
+    data = read_json(probe_path)
+    if data and data.get('version') == MEDIA_PROBE_VERSION:
+        info = MediaInfo(**data['info'])
+    else:
+        info = read_media_info(media_path)
+        if not info:
+            return None
+        write_json_atomic(probe_path, {"version": MEDIA_PROBE_VERSION, "info": info._asdict()})
+    _media_info_cache.put(sha256, info, len(json.dumps(info)))
+    return info
+
+
+# Function to resize images (Fix FFmpeg issue: height must be divisible by 2)
+def resize_image(image_path):
+    """
+    Resize image to ensure width and height are even numbers.
+    This is required by FFmpeg's H.264 encoder which needs dimensions divisible by 2.
+    
+    Args:
+        image_path: Path to the image file to resize
+    """
+    with Image.open(image_path) as img:
+        width, height = img.size
+        
+        # Ensure both width and height are even (divisible by 2)
+        # Add 1 pixel if dimension is odd
+        if width % 2 != 0:
+            width += 1
+        if height % 2 != 0:
+            height += 1
+
+        # Resize and save the image with corrected dimensions
+        resized_img = img.resize((width, height))
+        resized_img.save(image_path)
+
+
+# Function to use a file from one of the on-disk caches
+def _use_cached_blob(blob_path, dest_path):
+    """
+    Link a cached file to dest_path and mark it as recently used.
+    
+    Returns:
+        bool: True on success, False if the blob has been evicted meanwhile
+    """
+    try:
+        link_or_copy(blob_path, dest_path)
+        os.utime(blob_path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+# Function to trim the media cache to its byte budget
+def evict_media_cache():
+    """
+    Evict least recently used blobs from the media cache and drop the URL
+    entries that pointed to them. Skipped if another process is already evicting.
+    """
+    with file_lock(os.path.join(MEDIA_CACHE_FOLDER, '.lock'), blocking=False) as locked:
+        if not locked:
+            return
+        if not evict_lru(MEDIA_BLOBS_FOLDER, MEDIA_CACHE_MAX_BYTES):
+            return
+        for entry in os.scandir(MEDIA_URLS_FOLDER):
+            if not entry.name.endswith('.json'):
+                continue
+            data = read_json(entry.path)
+            if not data or not os.path.exists(os.path.join(MEDIA_BLOBS_FOLDER, data['sha256'])):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+        # Probe results of evicted media
+        for entry in os.scandir(MEDIA_PROBES_FOLDER):
+            sha256 = entry.name.removesuffix('.json')
+            if entry.name.endswith('.json') and not os.path.exists(os.path.join(MEDIA_BLOBS_FOLDER, sha256)):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+# Function to fetch a URL through the on-disk media cache
+def fetch_cached_media(url, dest_path):
+    """
+    Fetch url into dest_path through the content-addressed media cache.
+    
+    Cached files are stored once per content hash and looked up by URL.
+    Entries younger than MEDIA_CACHE_TTL are used without any network access,
+    older ones are revalidated with ETag/Last-Modified (304 keeps the cached file).
+    
+    Args:
+        url: URL of the file to download
+        dest_path: Path where the file should be placed
+        
+    Returns:
+        str: SHA-256 of the file content, or None if the download failed
+    """
+    entry_path = os.path.join(MEDIA_URLS_FOLDER, sha256_text(url) + '.json')
+    entry = read_json(entry_path)
+    headers = {}
+    if entry:
+        blob_path = os.path.join(MEDIA_BLOBS_FOLDER, entry['sha256'])
+        # Fresh entry: skip the network entirely
+        if time.time() - entry['checked_at'] < MEDIA_CACHE_TTL and _use_cached_blob(blob_path, dest_path):
+            return entry['sha256']
+        # Stale entry: ask the server whether our copy is still valid
+        if os.path.exists(blob_path):
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+    # Stream download to handle large files efficiently
+    # The context manager returns the connection to the pool when done
+    with get_http_session().get(url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status_code == 304 and headers:
+            if _use_cached_blob(blob_path, dest_path):
+                entry['checked_at'] = time.time()
+                write_json_atomic(entry_path, entry)
+                return entry['sha256']
+            # Blob was evicted while revalidating: download it again
+            os.remove(entry_path)
+            return fetch_cached_media(url, dest_path)
+        if response.status_code != 200:
+            return None
+
+        # Write file in chunks to avoid memory issues with large files,
+        # hashing the content on the way
+        digest = hashlib.sha256()
+        tmp_path = os.path.join(MEDIA_BLOBS_FOLDER, f".{uuid.uuid4().hex}.part")
+        try:
+            with open(tmp_path, "wb") as file:
+                for chunk in response.iter_content(1024):
+                    file.write(chunk)
+                    digest.update(chunk)
+        except Exception:
+            remove_files([tmp_path])
+            raise
+
+    # Store the content once per hash (identical files from different URLs share a blob)
+    content_hash = digest.hexdigest()
+    blob_path = os.path.join(MEDIA_BLOBS_FOLDER, content_hash)
+    os.replace(tmp_path, blob_path)
+    link_or_copy(blob_path, dest_path)
+    write_json_atomic(entry_path, {
+        "url": url,
+        "sha256": content_hash,
+        "etag": response.headers.get('ETag'),
+        "last_modified": response.headers.get('Last-Modified'),
+        "checked_at": time.time(),
+    })
+    evict_media_cache()
+    return content_hash
+
+
+# Function to download files from a given URL and save them
+def download_file(url, extension, folder):
+    """
+    Download a file from URL and save it to the specified folder.
+    Images are automatically resized to meet FFmpeg requirements.
+    
+    Args:
+        url: URL of the file to download
+        extension: File extension (mp3, jpg, etc.)
+        folder: Destination folder to save the file
+        
+    Returns:
+        str: Path to the downloaded file, or None if download failed
+    """
+    try:
+        # Generate unique filename using UUID to avoid conflicts
+        filename = f"{uuid.uuid4()}.{extension}"
+        file_path = os.path.join(folder, filename)
+
+        # Served from the media cache when possible, downloaded otherwise
+        if fetch_cached_media(url, file_path):
+            # # Resize if it's an image to ensure compatibility with FFmpeg
+            # if extension in {"jpg", "png", "jpeg", "webp"}:
+            #     resize_image(file_path)
+
+            return file_path
+    except Exception as e:
+        print(f"Error downloading file from {url}: {e}")
+    return None
+
+
+# Function to hash the content of a file
+def file_sha256(path):
+    """
+    Return the hex SHA-256 digest of a file's content.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Function to download several files in parallel
+def download_files(items, folder, max_workers=DOWNLOAD_CONCURRENCY):
+    """
+    Download several files concurrently using a bounded thread pool.
+    At most max_workers downloads run at once for this call, and at most
+    DOWNLOAD_GLOBAL_CONCURRENCY downloads run at once in the worker process.
+    
+    Args:
+        items: List of (url, extension) tuples to download
+        folder: Destination folder to save the files
+        max_workers: Maximum number of parallel downloads for this call
+        
+    Returns:
+        list: Paths in the same order as items (None for failed downloads)
+    """
+    if not items:
+        return []
+
+    def fetch(item):
+        url, extension = item
+        # Wait for a free slot in the process-wide download limit
+        with _download_slots:
+            return download_file(url, extension, folder)
+
+    workers = max(1, min(max_workers, len(items)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fetch, items))
+
+
+# Function to delete temporary files that are no longer needed
+def remove_files(paths):
+    """
+    Delete the given files, ignoring paths that are None or already gone.
+    
+    Args:
+        paths: Iterable of file paths
+    """
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+# Function to collect every setting that affects the rendered video
+def render_settings(data):
+    """
+    Build the normalized rendering settings for a /convert request.
+    Everything that changes the output video must be part of this dict,
+    since it is hashed into the output cache key.
+    
+    Args:
+        data: The /convert JSON payload
+        
+    Returns:
+        dict: Rendering settings
+        
+    Raises:
+        RenderError: If the payload asks for an unknown encoding profile or fit mode,
+                     or an invalid loudness target (status 400)
+    """
+    profile_name = data.get('profile') or DEFAULT_ENCODING_PROFILE
+    if not isinstance(profile_name, str) or profile_name not in ENCODING_PROFILES:
+        raise RenderError(
+            f"Unknown profile '{profile_name}'. Available: {', '.join(ENCODING_PROFILES)}.", 400)
+    fit = data.get('fit') or 'crop'
+    if not isinstance(fit, str) or fit not in FIT_MODES:
+        raise RenderError(f"Unknown fit '{fit}'. Available: {', '.join(FIT_MODES)}.", 400)
+    loudness = data.get('loudness')
+    if loudness is not None:
+        if isinstance(loudness, bool) or not isinstance(loudness, (int, float)) \
+                or not LOUDNESS_RANGE[0] <= loudness <= LOUDNESS_RANGE[1]:
+            raise RenderError(
+                f"loudness must be a number between {LOUDNESS_RANGE[0]:g} and {LOUDNESS_RANGE[1]:g} LUFS.", 400)
+        loudness = float(loudness)
+
+    return {
+        "image_duration": IMAGE_DURATION,
+        # Everything that changes the encoded image segments
+        "video": {
+            "width": VIDEO_WIDTH,
+            "height": VIDEO_HEIGHT,
+            "codec": "libx264",
+            "pix_fmt": "yuv420p",
+            "fit": fit,
+            **ENCODING_PROFILES[profile_name],
+        },
+        # Everything that changes the encoded audio track
+        "audio": {
+            "codec": "aac",
+            "bitrate": AUDIO_BITRATE or None,
+            "sample_rate": AUDIO_SAMPLE_RATE or None,
+            "loudness": loudness,
+        },
+    }
+
+
+# Function to compute the output cache key of a render
+def output_cache_key(inputs, settings):
+    """
+    Hash the inputs and settings of a render into a canonical cache key.
+    
+    Args:
+        inputs: Dict identifying the inputs (URLs or content hashes)
+        settings: Rendering settings from render_settings()
+        
+    Returns:
+        str: Hex SHA-256 cache key
+    """
+    canonical = json.dumps({
+        "version": OUTPUT_CACHE_VERSION,
+        "inputs": inputs,
+        "settings": settings,
+    }, sort_keys=True, separators=(',', ':'))
+    return sha256_text(canonical)
+
+
+# Function to compute the output cache key of a /convert request
+def request_cache_key(audio_url, image_urls, settings):
+    """
+    Return the output cache key of a request, based on its URLs and settings.
+    """
+    return output_cache_key({"audio_url": audio_url, "image_urls": image_urls}, settings)
+
+
+# Function to look up a previously rendered video
+def get_cached_output(cache_key):
+    """
+    Look up a rendered video in the output cache.
+    On a hit the cached file is linked to a new name in VIDEO_FOLDER,
+    so the returned video can be deleted with /delete like any other output.
+    
+    Args:
+        cache_key: Key from output_cache_key()
+        
+    Returns:
+        str: Path of the video in VIDEO_FOLDER, or None on a cache miss
+    """
+    if OUTPUT_CACHE_MAX_BYTES <= 0:
+        return None
+    cached_path = os.path.join(OUTPUT_CACHE_FOLDER, cache_key + '.mp4')
+    try:
+        if time.time() - os.path.getmtime(cached_path) > OUTPUT_CACHE_MAX_AGE:
+            return None
+        video_path = os.path.join(VIDEO_FOLDER, str(uuid.uuid4()) + "_output_video.mp4")
+        link_or_copy(cached_path, video_path)
+        return video_path
+    except FileNotFoundError:
+        return None
+
+
+# Function to store a rendered video in the output cache
+def store_output(video_path, cache_keys):
+    """
+    Add a rendered video to the output cache under each of the given keys,
+    then evict expired and oldest renders beyond the byte budget.
+    
+    Args:
+        video_path: Path of the rendered video
+        cache_keys: Keys from output_cache_key()
+    """
+    if OUTPUT_CACHE_MAX_BYTES <= 0:
+        return
+    for cache_key in cache_keys:
+        tmp_path = os.path.join(OUTPUT_CACHE_FOLDER, f".{uuid.uuid4().hex}.tmp")
+        link_or_copy(video_path, tmp_path)
+        os.replace(tmp_path, os.path.join(OUTPUT_CACHE_FOLDER, cache_key + '.mp4'))
+    with file_lock(os.path.join(OUTPUT_CACHE_FOLDER, '.lock'), blocking=False) as locked:
+        if locked:
+            evict_lru(OUTPUT_CACHE_FOLDER, OUTPUT_CACHE_MAX_BYTES, OUTPUT_CACHE_MAX_AGE)
+
+
+# Function to write an ffmpeg concat demuxer list
+def write_concat_list(list_path, paths):
+    """
+    Write a concat demuxer file playing the given media files in order.
+    
+    Args:
+        list_path: Path of the list file to write
+        paths: Media files in playback order
+    """
+    with open(list_path, "w") as f:
+        for path in paths:
+            f.write(f"file '{os.path.abspath(path)}'\n")  # Use absolute path for files
+
+
+# Function to build the ffmpeg options encoding a slideshow segment
+def video_encoder_options(video_settings):
+    """
+    Return the ffmpeg output options for the "video" part of render_settings().
+    
+    Options:
+    -c:v: Video codec (H.264)
+    -preset, -tune, -crf, -g: From the encoding profile (see ENCODING_PROFILES)
+    -pix_fmt yuv420p: Pixel format for maximum compatibility
+    -threads ENCODE_THREADS: Share the CPUs between the concurrent encodes
+    
+    Input frames are already yuv420p at the output resolution (see prepare_frames).
+    """
+    options = [
+        '-c:v', video_settings['codec'], '-preset', video_settings['preset'],
+        '-crf', str(video_settings['crf']), '-g', str(video_settings['keyint']),
+    ]
+    if video_settings['tune']:
+        options += ['-tune', video_settings['tune']]
+    return options + ['-pix_fmt', video_settings['pix_fmt'], '-threads', str(ENCODE_THREADS)]
+
+
+# Function to get the segment cache path of one image
+def segment_cache_path(image_hash, settings):
+    """
+    A still image always encodes to the same segment for the same settings,
+    so segments are cached by (image hash, duration, video settings).
+
+    Args:
+        image_hash: SHA-256 of the image content
+        settings: Rendering settings from render_settings()
+
+    Returns:
+        str: Path of the segment in SEGMENT_CACHE_FOLDER (may not exist)
+    """
+    segment_key = sha256_text(json.dumps({
+        "version": SEGMENT_CACHE_VERSION,
+        "image_sha256": image_hash,
+        "duration": settings['image_duration'],
+        "video": settings['video'],
+    }, sort_keys=True))
+    return os.path.join(SEGMENT_CACHE_FOLDER, segment_key + '.mp4')
+
+
+# Function to encode the video segment showing one image
+def encode_segment(frame, segment_path, settings, dest_path):
+    """
+    Encode a raw frame from prepare_frames() into the video segment showing
+    it for the image duration, while holding an encoder slot. The frame is
+    piped to ffmpeg's stdin, so it never goes through the disk. The segment
+    is added to the segment cache and placed at dest_path.
+
+    Args:
+        frame: Raw yuv420p frame
+        segment_path: Cache path from segment_cache_path()
+        settings: Rendering settings from render_settings()
+        dest_path: Where to place the segment (.mp4)
+
+    Raises:
+        subprocess.CalledProcessError: If ffmpeg fails
+    """
+    video_settings = settings['video']
+
+    # -f rawvideo -pix_fmt -s -framerate -i pipe:0: One raw yuv420p frame from stdin
+    # loop: Repeat the frame to the exact number of frames for the display duration
+    frame_count = round(settings['image_duration'] * video_settings['fps'])
+    tmp_path = os.path.join(SEGMENT_CACHE_FOLDER, f".{uuid.uuid4().hex}.mp4")
+    cmd = [
+        'ffmpeg', '-y', '-f', 'rawvideo', '-pix_fmt', video_settings['pix_fmt'],
+        '-s', f"{video_settings['width']}x{video_settings['height']}",
+        '-framerate', str(video_settings['fps']), '-i', 'pipe:0',
+        '-vf', f"loop=loop={frame_count - 1}:size=1:start=0", '-frames:v', str(frame_count),
+    ] + video_encoder_options(video_settings) + ['-an', tmp_path]
+    try:
+        with encode_slot():
+            run_ffmpeg(cmd, input=memoryview(frame))
+    except Exception:
+        remove_files([tmp_path])
+        raise
+    os.replace(tmp_path, segment_path)
+    link_or_copy(segment_path, dest_path)
+
+    with file_lock(os.path.join(SEGMENT_CACHE_FOLDER, '.lock'), blocking=False) as locked:
+        if locked:
+            evict_lru(SEGMENT_CACHE_FOLDER, SEGMENT_CACHE_MAX_BYTES)
+
+
+# Function to check whether the source audio can go into the output unchanged
+def can_copy_audio(audio_info, audio_settings):
+    """
+    Check whether the source audio already matches the "audio" part of
+    render_settings(), so it can be stream-copied into the MP4 output.
+
+    Args:
+        audio_info: MediaInfo of the audio from probe_media()
+        audio_settings: The "audio" part of render_settings()
+
+    Returns:
+        bool: True if the audio needs no encoding
+    """
+    if audio_info.codec not in MP4_COPY_AUDIO_CODECS or audio_settings['loudness'] is not None:
+        return False
+    if audio_settings['sample_rate'] and audio_info.sample_rate != audio_settings['sample_rate']:
+        return False
+    # Bigger sources are re-encoded to the target bitrate, smaller ones can't gain from it
+    if audio_settings['bitrate'] and (audio_info.bit_rate or 0) > audio_settings['bitrate']:
+        return False
+    return True
+
+
+# Function to measure the loudness of an audio file, cached by content hash
+def measure_loudness(audio_path, audio_hash):
+    """
+    Run the measurement pass of ffmpeg's loudnorm filter (EBU R128) while
+    holding an encoder slot. The measured input statistics don't depend on
+    the target, so they are cached per audio content and any later target
+    only needs the normalization pass.
+
+    Args:
+        audio_path: Path of the downloaded audio
+        audio_hash: SHA-256 of the audio content
+
+    Returns:
+        dict: input_i, input_tp, input_lra and input_thresh as reported by loudnorm
+
+    Raises:
+        subprocess.CalledProcessError: If ffmpeg fails
+    """
+    stats_path = os.path.join(AUDIO_CACHE_FOLDER, f"{audio_hash}.loudness.json")
+    stats = read_json(stats_path)
+    if stats:
+        return stats
+
+    # I=-24: Any target will do, the input measurements don't depend on it
+    # print_format=json: loudnorm prints its measurements as JSON at the end of stderr
+    # -f null -: Decode and measure only, nothing is written
+    cmd = [
+        'ffmpeg', '-hide_banner', '-nostats', '-i', audio_path, '-map', '0:a:0',
+        '-af', f"loudnorm=I=-24:TP={LOUDNESS_TRUE_PEAK}:LRA={LOUDNESS_LRA}:print_format=json",
+        '-f', 'null', '-'
+    ]
+    with encode_slot():
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, cmd, stderr=result.stderr)
+    report = json.loads(result.stderr[result.stderr.rindex('{'):result.stderr.rindex('}') + 1])
+    stats = {key: report[key] for key in ('input_i', 'input_tp', 'input_lra', 'input_thresh')}
+    write_json_atomic(stats_path, stats)
+    return stats
+
+
+# Function to build the loudnorm filter normalizing to a target
+def loudnorm_filter(target, stats):
+    """
+    Build the normalization pass of ffmpeg's loudnorm filter from the
+    measurements of measure_loudness(). With measurements, loudnorm applies
+    a single linear gain when the true peak allows it; silent audio (no
+    finite measurements) falls back to dynamic normalization.
+
+    Args:
+        target: Integrated loudness target in LUFS
+        stats: Measurements from measure_loudness()
+
+    Returns:
+        str: The -af filter
+    """
+    audio_filter = f"loudnorm=I={target:g}:TP={LOUDNESS_TRUE_PEAK}:LRA={LOUDNESS_LRA}"
+    try:
+        measured = [float(stats[key]) for key in ('input_i', 'input_tp', 'input_lra', 'input_thresh')]
+    except (KeyError, TypeError, ValueError):
+        return audio_filter
+    if not all(math.isfinite(value) for value in measured):
+        return audio_filter
+    return audio_filter + (
+        ":measured_I={}:measured_TP={}:measured_LRA={}:measured_thresh={}:linear=true".format(*measured)
+    )
+
+
+# Function to get the audio track of a render as AAC
+def get_audio_track(audio_path, audio_hash, audio_info, audio_settings, dest_path):
     """
-    Downloads an image from a URL and resizes it to the exact new_width and new_height.
-    Note: This might distort the image if the aspect ratio is not maintained.
+    Get a version of the audio that can be stream-copied into the MP4 output.
+    Sources matching the audio settings are used as they are. Anything else
+    is encoded to AAC once, while holding an encoder slot, and cached by
+    (content hash, audio settings), so a reused audio track is never
+    encoded twice.
 
-    :param image_url: The URL of the input image.
-    :param new_width: The desired new width in pixels.
-    :param new_height: The desired new height in pixels.
-    :param output_filename: The filename to save the resized image.
-    :return: The saved file path or None if an error occurs.
+    Args:
+        audio_path: Path of the downloaded audio
+        audio_hash: SHA-256 of the audio content
+        audio_info: MediaInfo of the audio from probe_media()
+        audio_settings: The "audio" part of render_settings()
+        dest_path: Where to place the transcoded track (.m4a)
+
+    Returns:
+        str: audio_path if it can be copied as is, dest_path otherwise
+
+    Raises:
+        subprocess.CalledProcessError: If ffmpeg fails
     """
+    if can_copy_audio(audio_info, audio_settings):
+        return audio_path
 
-    output_filename = str(uuid.uuid4()) + "_" + output_filename
+    track_key = sha256_text(json.dumps({
+        "version": AUDIO_CACHE_VERSION,
+        "audio_sha256": audio_hash,
+        "audio": audio_settings,
+    }, sort_keys=True))
+    track_path = os.path.join(AUDIO_CACHE_FOLDER, track_key + '.m4a')
+    if _use_cached_blob(track_path, dest_path):
+        return dest_path
 
+    # -map 0:a:0: First audio stream only (no cover art)
+    # -af loudnorm: Loudness normalization in this same encode, when a target is set
+    # -b:a, -ar: Target bitrate and sample rate, when set (loudnorm resamples
+    #            to 192 kHz internally, so the source rate is restored after it)
+    # The track is kept in an MP4 container rather than as a raw ADTS stream,
+    # so the encoder delay is recorded and the mux copies it without a bitstream filter
+    tmp_path = os.path.join(AUDIO_CACHE_FOLDER, f".{uuid.uuid4().hex}.m4a")
+    cmd = ['ffmpeg', '-y', '-i', audio_path, '-map', '0:a:0', '-c:a', audio_settings['codec']]
+    sample_rate = audio_settings['sample_rate']
+    if audio_settings['loudness'] is not None:
+        stats = measure_loudness(audio_path, audio_hash)
+        cmd += ['-af', loudnorm_filter(audio_settings['loudness'], stats)]
+        sample_rate = sample_rate or audio_info.sample_rate or 48000
+    if audio_settings['bitrate']:
+        cmd += ['-b:a', str(audio_settings['bitrate'])]
+    if sample_rate:
+        cmd += ['-ar', str(sample_rate)]
+    cmd.append(tmp_path)
     try:
-        # 1. Download the image data
-        response = requests.get(image_url)
-        response.raise_for_status() # Check for HTTP errors
+        with encode_slot():
+            run_ffmpeg(cmd)
+    except Exception:
+        remove_files([tmp_path])
+        raise
+    os.replace(tmp_path, track_path)
+    link_or_copy(track_path, dest_path)
+
+    with file_lock(os.path.join(AUDIO_CACHE_FOLDER, '.lock'), blocking=False) as locked:
+        if locked:
+            evict_lru(AUDIO_CACHE_FOLDER, AUDIO_CACHE_MAX_BYTES)
+    return dest_path
 
-        # 2. Open the image using Pillow from byte content
-        image_data = BytesIO(response.content)
-        img = Image.open(image_data)
-
-        # 3. Resize the image to the exact dimensions
-        new_size = (new_width, new_height)
-        # Use Image.Resampling.LANCZOS for high-quality resampling, especially for downscaling
-        # resized_img = img.resize(new_size, Image.Resampling.LANCZOS)
-        cropped_and_resized_img = ImageOps.fit(
-            img,
-            new_size,
-            method=Image.Resampling.LANCZOS,  # Use LANCZOS for best quality
-            centering=(0.5, 0.5)  # Centering tuple (x, y) - 0.5 means center
-        )
+
+# Function to run ffmpeg while reporting its progress
+def run_ffmpeg(cmd, duration=None, progress=None, input=None):
+    """
+    Run an ffmpeg command, optionally reporting how far the encode is.
+    
+    Args:
+        cmd: ffmpeg command line (starting with 'ffmpeg')
+        duration: Expected output duration in seconds
+        progress: Optional callback receiving the completed fraction (0.0 - 1.0)
+        input: Optional bytes-like data written to ffmpeg's stdin (read with -i pipe:0);
+               progress is not reported for such commands
         
-        # 4. Save the resized image
-        output_format = img.format if img.format else "JPEG"
-        cropped_and_resized_img.save(output_filename, format=output_format)
+    Raises:
+        subprocess.CalledProcessError: If ffmpeg fails
+    """
+    if progress is None or not duration or input is not None:
+        subprocess.run(cmd, input=input, check=True)
+        return
+
+    # -progress pipe:1 makes ffmpeg print key=value progress lines on stdout
+    cmd = cmd[:1] + ['-progress', 'pipe:1', '-nostats'] + cmd[1:]
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True) as process:
+        for line in process.stdout:
+            key, _, value = line.strip().partition('=')
+            # out_time_ms is also in microseconds (older ffmpeg versions)
+            if key in ('out_time_us', 'out_time_ms') and value.isdigit():
+                progress(min(1.0, int(value) / 1_000_000 / duration))
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+
+
+# Error raised when a video cannot be rendered
+class RenderError(Exception):
+    """
+    Error raised while rendering a video.
+    Carries the HTTP status code the API should answer with.
+    """
+
+    def __init__(self, message, status_code=500, retry_after=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after  # Seconds, for overload errors
+
 
-        print(f"Image successfully resized and saved at: {output_filename}")
-        print(f"Original size: {img.size}, New size: {cropped_and_resized_img.size}")
+# Function to hold one of the encoder slots shared by all worker processes
+@contextmanager
+def encode_slot():
+    """
+    Wait for one of the RENDER_CONCURRENCY encoder slots and hold it for the
+    duration of the block, so the container never runs more ffmpeg encodes
+    than it has CPU for. Slots are flock()ed files shared by all workers.
+    """
+    while True:
+        for slot in range(RENDER_CONCURRENCY):
+            slot_path = os.path.join(RENDER_SLOT_FOLDER, f"slot-{slot}.lock")
+            with file_lock(slot_path, blocking=False) as locked:
+                if locked:
+                    yield
+                    return
+        time.sleep(0.2)
 
-        return output_filename
+
+# Function to coalesce identical renders across worker processes
+@contextmanager
+def single_flight(key):
+    """
+    Hold the render lock of a cache key for the duration of the block.
+    Identical requests on any gunicorn worker wait here until the first
+    render finishes, then take its result (see render_video).
     
-    except requests.exceptions.RequestException as e:
-        print(f"Error downloading image: {e}")
-        return None
-    except Exception as e:
-        print(f"Error processing image: {e}")
-        return None
+    Args:
+        key: Output cache key of the render
+    
+    Yields:
+        bool: True if another render of the key held the lock when we arrived
+    """
+    lock_path = os.path.join(OUTPUT_CACHE_FOLDER, f".{key}.lock")
+    waited = False
+    while True:
+        lock_file = open(lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            waited = True
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # The previous holder unlinks the lock file when done: retry if we
+        # locked a file that is no longer the one at lock_path
+        try:
+            if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        lock_file.close()
+    try:
+        yield waited
+    finally:
+        remove_files([lock_path])
+        lock_file.close()
 
 
-# Function to check if file extension is allowed
-def allowed_file(filename):
+# Function to remove render results that no waiting request picked up
+def cleanup_render_results():
     """
-    Check if the file has an allowed extension.
+    Delete the render results (see render_video) older than RENDER_RESULT_MAX_AGE.
+    """
+    expired_before = time.time() - RENDER_RESULT_MAX_AGE
+    for entry in os.scandir(OUTPUT_CACHE_FOLDER):
+        if entry.name.endswith('.result'):
+            try:
+                if entry.stat().st_mtime < expired_before:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass  # Removed by another worker
+
+
+# Function to create a video from audio and image URLs
+def render_video(audio_url, image_urls, settings, progress=None):
+    """
+    Create a video from audio and images, reusing the output cache.
+    Concurrent identical requests are rendered only once: the render
+    links its video to a short-lived result file next to its lock, which
+    the requests that waited on the lock take when the output cache
+    doesn't have it (e.g. when it is disabled).
     
     Args:
-        filename: Name of the file to check
+        audio_url: URL of the audio file
+        image_urls: List of image URLs
+        settings: Rendering settings from render_settings()
+        progress: Optional callback progress(stage, fraction) with stage
+                  'downloading', 'waiting', 'preparing', 'encoding' or 'muxing'
+                  and fraction between 0.0 and 1.0
         
     Returns:
-        Boolean: True if extension is allowed, False otherwise
+        str: Path of the video in VIDEO_FOLDER
+        
+    Raises:
+        RenderError: If the video cannot be created
     """
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    # Serve identical requests from the output cache without downloading anything
+    request_key = request_cache_key(audio_url, image_urls, settings)
+    cached_video = get_cached_output(request_key)
+    if cached_video:
+        return cached_video
+
+    with single_flight(request_key) as waited:
+        # An identical request may have finished while we were waiting
+        cached_video = get_cached_output(request_key)
+        if cached_video:
+            return cached_video
+        result_path = os.path.join(OUTPUT_CACHE_FOLDER, f".{request_key}.result")
+        if waited:
+            video_path = os.path.join(VIDEO_FOLDER, str(uuid.uuid4()) + "_output_video.mp4")
+            try:
+                link_or_copy(result_path, video_path)
+                return video_path
+            except FileNotFoundError:
+                pass  # The render we waited for failed
+
+        # Results of earlier renders are only for the requests that waited on them
+        remove_files([result_path])
+        cleanup_render_results()
+        video_path = _render_uncached(audio_url, image_urls, settings, request_key, progress)
+        tmp_path = os.path.join(OUTPUT_CACHE_FOLDER, f".{uuid.uuid4().hex}.tmp")
+        link_or_copy(video_path, tmp_path)
+        os.replace(tmp_path, result_path)
+        return video_path
+
+
+# Function to download the inputs and run ffmpeg
+def _render_uncached(audio_url, image_urls, settings, request_key, progress=None):
+    """
+    Download the inputs and encode the video (see render_video).
+    """
+    if progress is None:
+        progress = lambda stage, fraction: None
+
+    # Download the audio file and all image files in parallel
+    progress('downloading', 0.0)
+    # The real audio format is probed from the content (see probe_media)
+    downloads = [(audio_url, "audio")] + [(img_url, "jpg") for img_url in image_urls]
+    downloaded_paths = download_files(downloads, UPLOAD_FOLDER)
+    audio_path = downloaded_paths[0]
+    image_paths = [path for path in downloaded_paths[1:] if path]
+
+    # Temporary files removed when the render is over
+    temp_files = [audio_path] + image_paths
+    segment_list_file = os.path.join(UPLOAD_FOLDER, str(uuid.uuid4()) + "_segments.txt")
+    temp_files.append(segment_list_file)
+
+    try:
+        if not audio_path:
+            raise RenderError("Failed to download audio file.", 400)
+
+        # Validate that at least one image was downloaded successfully
+        if not image_paths:
+            raise RenderError("No valid images downloaded.", 400)
+
+        # Same media under different URLs also hits the cache
+        audio_hash = file_sha256(audio_path)
+        image_hashes = [file_sha256(path) for path in image_paths]
+        content_key = output_cache_key({
+            "audio_sha256": audio_hash,
+            "image_sha256": image_hashes,
+        }, settings)
+        cached_video = get_cached_output(content_key)
+        if cached_video:
+            store_output(cached_video, [request_key])
+            return cached_video
+
+        # Get the audio duration to calculate how many images are needed
+        audio_info = probe_media(audio_path, audio_hash)
+        if not audio_info or not audio_info.codec:
+            raise RenderError("Could not read the audio file.", 400)
+        if not audio_info.duration:
+            raise RenderError("Could not determine the audio duration.", 400)
+        audio_duration = audio_info.duration
+
+        # Images beyond the audio duration would be cut anyway
+        image_duration = settings['image_duration']
+        needed = math.ceil(audio_duration / image_duration)
+        image_paths, image_hashes = image_paths[:needed], image_hashes[:needed]
 
+        # Generate unique filename using UUID to avoid conflicts
+        video_filename = str(uuid.uuid4()) + "_output_video.mp4"
+        video_path = os.path.join(VIDEO_FOLDER, video_filename)
 
-# Function to get the audio duration using ffmpeg
-def get_audio_duration(audio_path):
+        progress('waiting', 0.0)
+        try:
+            # Encode each distinct image once into a short segment, or reuse it
+            # from the segment cache
+            distinct_images = dict(zip(image_hashes, image_paths))
+            segment_paths = {}
+            missing = []
+            for image_hash in distinct_images:
+                segment_paths[image_hash] = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4()}_segment.mp4")
+                temp_files.append(segment_paths[image_hash])
+                if not _use_cached_blob(segment_cache_path(image_hash, settings), segment_paths[image_hash]):
+                    missing.append(image_hash)
+
+            # Every segment starts with a keyframe, so they are independent
+            # and encoded in parallel on SEGMENT_WORKERS ffmpeg processes,
+            # along with the audio if it has to be transcoded.
+            # The missing images are decoded into raw frames ffmpeg can encode
+            # directly, a chunk at a time: the next chunk is prepared while the
+            # previous one is encoded, so at most two chunks of frames are in
+            # memory however many images the video has
+            audio_track = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4()}_audio.m4a")
+            temp_files.append(audio_track)
+            video_settings = settings['video']
+            chunk_size = max(1, SEGMENT_WORKERS, ENCODE_THREADS)
+            workers = max(1, min(SEGMENT_WORKERS, len(missing))) + 1
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                audio_future = executor.submit(
+                    get_audio_track, audio_path, audio_hash, audio_info, settings['audio'], audio_track)
+                encoded = 0
+                pending = []
+                for start in range(0, len(missing), chunk_size):
+                    chunk = missing[start:start + chunk_size]
+                    with encode_slot():
+                        if not start:
+                            progress('preparing', 0.0)
+                        frames = prepare_frames(
+                            [distinct_images[image_hash] for image_hash in chunk],
+                            (video_settings['width'], video_settings['height']),
+                            video_settings['fit']
+                        )
+                    for future in as_completed(pending):
+                        future.result()
+                        encoded += 1
+                        progress('encoding', encoded / len(missing))
+                    pending = [
+                        executor.submit(
+                            encode_segment, frame, segment_cache_path(image_hash, settings),
+                            settings, segment_paths[image_hash]
+                        )
+                        for image_hash, frame in zip(chunk, frames)
+                    ]
+                    del frames
+                for future in as_completed(pending):
+                    future.result()
+                    encoded += 1
+                    progress('encoding', encoded / len(missing))
+                audio_track = audio_future.result()
+
+            with encode_slot():
+                # Assemble the slideshow by stream copy and add the audio
+                # -stream_loop -1: Loop the slideshow if the images can't cover the entire audio
+                # -f concat -safe 0: Read the segment list, allowing absolute paths
+                # -map: Slideshow video + first audio stream (ignore cover art in the audio file)
+                # -c:v copy -c:a copy: No encoding, the segments are H.264 and the audio track AAC
+                # -t audio_duration: Limit video duration to match audio
+                # -max_muxing_queue_size 1024: Increase buffer to prevent sync issues
+                write_concat_list(segment_list_file, [segment_paths[image_hash] for image_hash in image_hashes])
+                cmd = [
+                    'ffmpeg', '-y', '-stream_loop', '-1', '-f', 'concat', '-safe', '0', '-i', segment_list_file,
+                    '-i', audio_track, '-map', '0:v:0', '-map', '1:a:0', '-c:v', 'copy', '-c:a', 'copy',
+                    '-t', str(audio_duration), '-max_muxing_queue_size', '1024', video_path
+                ]
+                progress('muxing', 0.0)
+                run_ffmpeg(cmd, audio_duration, lambda fraction: progress('muxing', fraction))
+        except subprocess.CalledProcessError as e:
+            raise RenderError(f"Error during video generation: {e}", 500)
+
+        # Keep the result for identical requests
+        store_output(video_path, [request_key, content_key])
+        return video_path
+
+    finally:
+        # Clean up temporary files after success or error
+        # This ensures we don't fill up disk space with temp files
+        remove_files(temp_files)
+
+
+# Background render threads of the current process (see get_render_executor)
+_render_executor = None
+_render_executor_pid = None
+_render_executor_lock = threading.Lock()
+
+
+# Renders accepted by this process and not finished yet (see submit_render_job)
+_pending_renders = 0
+_pending_renders_lock = threading.Lock()
+
+
+# Unfinished jobs of the current process, kept alive by its heartbeat thread (see track_job)
+_active_jobs = set()
+_job_heartbeat_pid = None
+# Serializes the job record writes of this process (status updates and heartbeats)
+_job_records_lock = threading.Lock()
+
+
+# Function to get the thread pool running render jobs in this process
+def get_render_executor():
     """
-    Extract audio duration from an audio file using FFmpeg.
+    Return the thread pool that runs render jobs in this worker process.
+    A new pool is created after a fork, since threads do not survive it.
     
+    Returns:
+        ThreadPoolExecutor: The render thread pool
+    """
+    global _render_executor, _render_executor_pid
+    with _render_executor_lock:
+        if _render_executor is None or _render_executor_pid != os.getpid():
+            _render_executor = ThreadPoolExecutor(max_workers=RENDER_THREADS, thread_name_prefix='render')
+            _render_executor_pid = os.getpid()
+        return _render_executor
+
+
+# Function to get the path of a job status record
+def job_record_path(job_id):
+    """
+    Return the path of a job's status record, or None for malformed job ids.
+    """
+    if not re.fullmatch(r'[0-9a-f]{32}', job_id):
+        return None
+    return os.path.join(JOB_FOLDER, job_id + '.json')
+
+
+# Function to update a job status record
+def update_job(job_id, **fields):
+    """
+    Update fields of a job's status record.
+    Only the process that owns the job writes to its record.
+    """
+    path = job_record_path(job_id)
+    with _job_records_lock:
+        job = read_json(path) or {}
+        job.update(fields, updated_at=time.time())
+        write_json_atomic(path, job)
+
+
+# Function to send the heartbeats of the unfinished jobs of this process
+def _job_heartbeat_loop():
+    """
+    Refresh updated_at of every unfinished job of this process each
+    JOB_HEARTBEAT_INTERVAL, including jobs that are queued or waiting
+    on a render of another request and so report no progress.
+    Errors are logged and retried on the next beat: the thread is never
+    restarted, so it must not die.
+    """
+    while True:
+        time.sleep(JOB_HEARTBEAT_INTERVAL)
+        with _job_records_lock:
+            for job_id in list(_active_jobs):
+                try:
+                    path = job_record_path(job_id)
+                    job = read_json(path)
+                    if job and job['status'] in ('queued', 'running'):
+                        job['updated_at'] = time.time()
+                        write_json_atomic(path, job)
+                except Exception as e:
+                    print(f"Error updating the heartbeat of job {job_id}: {e}")
+
+
+# Function to start or stop sending heartbeats for a job
+def track_job(job_id, active=True):
+    """
+    Add a job to (or remove it from) the jobs kept alive by this process.
+    The heartbeat thread is started with the first job after a fork,
+    since threads do not survive it.
+    """
+    global _job_heartbeat_pid
+    with _job_records_lock:
+        if not active:
+            _active_jobs.discard(job_id)
+            return
+        if _job_heartbeat_pid != os.getpid():
+            _active_jobs.clear()
+            threading.Thread(target=_job_heartbeat_loop, name='job-heartbeat', daemon=True).start()
+            _job_heartbeat_pid = os.getpid()
+        _active_jobs.add(job_id)
+
+
+# Function to check whether the process owning a job still exists
+def job_owner_alive(job):
+    """
+    Check the owner pid of a job record. Records written on another host
+    (e.g. another container sharing the videos volume) can't be checked
+    and are assumed alive; the heartbeat still applies to them.
+    """
+    if job.get('host') != JOB_HOST or not job.get('pid'):
+        return True
+    try:
+        os.kill(job['pid'], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Function to get the state of a job as reported by the API
+def job_state(job):
+    """
+    Report an unfinished job as failed when its owner process is gone or its
+    heartbeat is older than JOB_HEARTBEAT_TIMEOUT, e.g. after the worker was
+    killed or restarted, so clients don't poll it forever.
+
     Args:
-        audio_path: Path to the audio file
-        
+        job: The job status record
+
     Returns:
-        float: Duration in seconds, or 0 if unable to determine
+        dict: The record as it should be reported
+    """
+    if job['status'] not in ('queued', 'running'):
+        return job
+    stale = time.time() - job.get('updated_at', 0) > JOB_HEARTBEAT_TIMEOUT
+    if stale or not job_owner_alive(job):
+        return dict(job, status='failed', error="The render was interrupted: its worker process stopped.",
+                    status_code=500)
+    return job
+
+
+# Function to run a render job in a background thread
+def _run_render_job(job_id, audio_url, image_urls, settings):
     """
-    # Run FFmpeg command to get file information
-    cmd = ['ffmpeg', '-i', audio_path]
-    result = subprocess.run(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    Render the video of a job and record the outcome in its status record.
     
-    # Parse the duration from the ffmpeg output
-    # FFmpeg outputs format: Duration: HH:MM:SS.ms
-    for line in result.stderr.splitlines():
-        if 'Duration' in line:
-            duration_str = line.split('Duration:')[1].split(',')[0].strip()
-            hours, minutes, seconds = map(float, duration_str.split(':'))
-            # Convert to total seconds
-            return hours * 3600 + minutes * 60 + seconds
-    return 0
+    Returns:
+        str: Path of the rendered video
+        
+    Raises:
+        RenderError: If the video cannot be created
+    """
+    last_update = [0.0]
 
+    def report(stage, fraction):
+        # Throttle status writes, ffmpeg reports progress many times per second
+        now = time.time()
+        if fraction in (0.0, 1.0) or now - last_update[0] >= 0.5:
+            last_update[0] = now
+            update_job(job_id, status='running', stage=stage, progress=round(fraction * 100))
 
-# Function to resize images (Fix FFmpeg issue: height must be divisible by 2)
-def resize_image(image_path):
+    try:
+        video_path = render_video(audio_url, image_urls, settings, progress=report)
+    except RenderError as e:
+        update_job(job_id, status='failed', error=e.message, status_code=e.status_code)
+        raise
+    except Exception as e:
+        update_job(job_id, status='failed', error=f"Error during video generation: {e}", status_code=500)
+        raise RenderError(f"Error during video generation: {e}", 500)
+
+    update_job(job_id, status='done', stage='done', progress=100, filename=os.path.basename(video_path))
+    return video_path
+
+
+# Function to remove job records that are no longer needed
+def cleanup_jobs():
     """
-    Resize image to ensure width and height are even numbers.
-    This is required by FFmpeg's H.264 encoder which needs dimensions divisible by 2.
+    Delete job status records older than JOB_MAX_AGE.
+    """
+    expired_before = time.time() - JOB_MAX_AGE
+    for entry in os.scandir(JOB_FOLDER):
+        if entry.name.endswith('.json'):
+            try:
+                if entry.stat().st_mtime < expired_before:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass  # Removed by another worker
+
+
+# Function to queue a render job
+def submit_render_job(audio_url, image_urls, settings):
+    """
+    Create a job status record and start rendering in the background.
     
     Args:
-        image_path: Path to the image file to resize
-    """
-    with Image.open(image_path) as img:
-        width, height = img.size
+        audio_url: URL of the audio file
+        image_urls: List of image URLs
+        settings: Rendering settings from render_settings()
         
-        # Ensure both width and height are even (divisible by 2)
-        # Add 1 pixel if dimension is odd
-        if width % 2 != 0:
-            width += 1
-        if height % 2 != 0:
-            height += 1
+    Returns:
+        tuple: (job_id, future) - the future resolves to the video path
+        
+    Raises:
+        RenderError: If the render queue of this process is full (status 503)
+    """
+    global _pending_renders
+    cleanup_jobs()
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    job = {
+        "job_id": job_id,
+        "status": "queued",
+        "stage": "queued",
+        "progress": 0,
+        "created_at": now,
+        "updated_at": now,
+        "host": JOB_HOST,
+        "pid": os.getpid(),
+    }
 
-        # Resize and save the image with corrected dimensions
-        resized_img = img.resize((width, height))
-        resized_img.save(image_path)
+    # Videos already in the output cache never wait in the queue
+    cached_video = get_cached_output(request_cache_key(audio_url, image_urls, settings))
+    if cached_video:
+        job.update(status='done', stage='done', progress=100, filename=os.path.basename(cached_video))
+        write_json_atomic(job_record_path(job_id), job)
+        future = Future()
+        future.set_result(cached_video)
+        return job_id, future
 
+    # Reject new work right away instead of queueing it without bound
+    with _pending_renders_lock:
+        if _pending_renders >= RENDER_QUEUE_SIZE:
+            raise RenderError("Server is busy, please retry later.", 503, retry_after=RENDER_RETRY_AFTER)
+        _pending_renders += 1
 
-# Function to download files from a given URL and save them
-def download_file(url, extension, folder):
+    def release(_):
+        global _pending_renders
+        track_job(job_id, active=False)
+        with _pending_renders_lock:
+            _pending_renders -= 1
+
+    write_json_atomic(job_record_path(job_id), job)
+    track_job(job_id)
+    future = get_render_executor().submit(_run_render_job, job_id, audio_url, image_urls, settings)
+    future.add_done_callback(release)
+    return job_id, future
+
+
+# Function to turn a RenderError into an API response
+def render_error_response(error):
     """
-    Download a file from URL and save it to the specified folder.
-    Images are automatically resized to meet FFmpeg requirements.
+    Build the JSON error response for a RenderError,
+    with a Retry-After header when the server is overloaded.
+    """
+    response = jsonify({"error": error.message})
+    response.status_code = error.status_code
+    if error.retry_after:
+        response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+# Function to validate a /convert or /jobs payload
+def parse_convert_request(data):
+    """
+    Validate the JSON payload of a render request.
     
     Args:
-        url: URL of the file to download
-        extension: File extension (mp3, jpg, etc.)
-        folder: Destination folder to save the file
+        data: The decoded JSON payload
         
     Returns:
-        str: Path to the downloaded file, or None if download failed
+        tuple: (audio_url, image_urls, settings)
+        
+    Raises:
+        RenderError: If required fields are missing or of the wrong type (status 400)
     """
-    try:
-        # Stream download to handle large files efficiently
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
-            # Generate unique filename using UUID to avoid conflicts
-            filename = f"{uuid.uuid4()}.{extension}"
-            file_path = os.path.join(folder, filename)
-            
-            # Write file in chunks to avoid memory issues with large files
-            with open(file_path, "wb") as file:
-                for chunk in response.iter_content(1024):
-                    file.write(chunk)
-
-            # # Resize if it's an image to ensure compatibility with FFmpeg
-            # if extension in {"jpg", "png", "jpeg", "webp"}:
-            #     resize_image(file_path)
+    # Validate required fields
+    if not isinstance(data, dict) or 'audio_url' not in data or 'image_urls' not in data:
+        raise RenderError("audio_url and image_urls are required.", 400)
+    if not isinstance(data['audio_url'], str):
+        raise RenderError("audio_url must be a string.", 400)
+    if not isinstance(data['image_urls'], list) or not all(isinstance(img_url, str) for img_url in data['image_urls']):
+        raise RenderError("image_urls must be a list of strings.", 400)
 
-            return file_path
-    except Exception as e:
-        print(f"Error downloading file from {url}: {e}")
-    return None
+    audio_url = data['audio_url'].strip()
+    image_urls = [img_url.strip() for img_url in data['image_urls']]
+    return audio_url, image_urls, render_settings(data)
 
 
 # Route to convert audio and images (from URLs) into a video
@@ -188,7 +2427,10 @@ def convert_to_video():
     Expected JSON payload:
     {
         "audio_url": "URL to audio file (mp3, wav)",
-        "image_urls": ["URL1", "URL2", ...] - Array of image URLs
+        "image_urls": ["URL1", "URL2", ...] - Array of image URLs,
+        "profile": "slideshow" - Optional encoding profile (see ENCODING_PROFILES),
+        "fit": "crop" - Optional image fitting, crop, letterbox or pad (see FIT_MODES),
+        "loudness": -16 - Optional loudness target in LUFS (EBU R128 normalization)
     }
     
     Returns:
@@ -196,95 +2438,86 @@ def convert_to_video():
     """
     data = request.json
 
-    # Validate required fields
-    if 'audio_url' not in data or 'image_urls' not in data:
-        return jsonify({"error": "audio_url and image_urls are required."}), 400
-
-    # Download audio file from provided URL
-    audio_url = data['audio_url']
-    audio_path = download_file(audio_url, "mp3", UPLOAD_FOLDER)
-    if not audio_path:
-        return jsonify({"error": "Failed to download audio file."}), 400
-
-    # Download all image files from provided URLs
-    image_urls = data['image_urls']
-    image_paths = []
-    for img_url in image_urls:
-        img_path = download_file(img_url, "jpg", UPLOAD_FOLDER)
-        if img_path:
-            image_paths.append(img_path)
-
-    # Validate that at least one image was downloaded successfully
-    if not image_paths:
-        return jsonify({"error": "No valid images downloaded."}), 400
-
-    # Get the audio duration to calculate how many images are needed
-    audio_duration = get_audio_duration(audio_path)
-    if audio_duration == 0:
-        return jsonify({"error": "Could not determine the audio duration."}), 500
-
-    # Calculate if we need to repeat images to cover entire audio duration
-    # Each image displays for 3 seconds
-    num_images = len(image_paths)
-    if num_images * 3 < audio_duration:  # If images can't cover entire duration with 3 sec per image
-        repeat_count = int(audio_duration // 3) + 1  # Calculate how many times to repeat images
-        image_paths = image_paths * repeat_count  # Repeat the images list
-
-    # Generate unique filenames using UUID to avoid conflicts
-    video_filename = str(uuid.uuid4()) + "_output_video.mp4"
-    video_path = os.path.join(VIDEO_FOLDER, video_filename)
-
-    img_sequence_filename = str(uuid.uuid4()) + "_img_sequence.txt"
-    img_sequence_file = os.path.join(UPLOAD_FOLDER, img_sequence_filename)
-
-    # Create the video using ffmpeg
+    # Run the render as a job and wait for it to finish
     try:
-        # Create a concat demuxer file for FFmpeg
-        # This file lists all images and their display duration
-        with open(img_sequence_file, "w") as f:
-            for image in image_paths:
-                f.write(f"file '{os.path.abspath(image)}'\n")  # Use absolute path for images
-                f.write(f"duration 3\n")  # Each image lasts 3 seconds
-
-        # Prepare the ffmpeg command to create the video with images and audio
-        # Command breakdown:
-        # -y: Overwrite output file if it exists
-        # -f concat: Use concat demuxer to read image sequence
-        # -safe 0: Allow absolute file paths
-        # -i img_sequence_file: Input image sequence
-        # -i audio_path: Input audio file
-        # -c:v libx264: Use H.264 video codec
-        # -preset medium: Balance between encoding speed and compression
-        # -r 30: Set frame rate to 30 fps
-        # -pix_fmt yuv420p: Pixel format for maximum compatibility
-        # -vf scale=1280:720: Scale video to 1280x720 resolution
-        # -t audio_duration: Limit video duration to match audio
-        # -threads 4: Use 4 threads for faster encoding
-        # -max_muxing_queue_size 1024: Increase buffer to prevent sync issues
-        cmd = [
-            'ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', img_sequence_file,
-            '-i', audio_path,
-            '-c:v', 'libx264', '-preset', 'medium', '-r', '25', '-pix_fmt', 'yuv420p',
-            '-vf', 'scale=720:1280', '-t', str(audio_duration), '-threads', '4',
-            '-max_muxing_queue_size', '1024', video_path
-        ]
-        # Execute FFmpeg command
-        subprocess.run(cmd, check=True)
-
-        # Return the generated video file as an attachment for download
-        return send_file(video_path, as_attachment=True)
-
-    except subprocess.CalledProcessError as e:
-        return jsonify({"error": f"Error during video generation: {e}"}), 500
-    finally:
-        # Clean up temporary files after success or error
-        # This ensures we don't fill up disk space with temp files
-        os.remove(audio_path)
-        for image_path in image_paths:
-            if os.path.exists(image_path):  # Only remove image if it exists
-                os.remove(image_path)
-        if os.path.exists(img_sequence_file):
-            os.remove(img_sequence_file)
+        audio_url, image_urls, settings = parse_convert_request(data)
+        _, future = submit_render_job(audio_url, image_urls, settings)
+        video_path = future.result()
+    except RenderError as e:
+        return render_error_response(e)
+
+    # Return the generated video file as an attachment for download
+    return send_file(video_path, as_attachment=True)
+
+
+# Route to start rendering a video in the background
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """
+    API endpoint to start creating a video without waiting for it.
+    
+    Expected JSON payload: same as /convert
+    
+    Returns:
+        JSON with the job id, its status (done right away for videos in the output cache)
+        and the URLs to poll its status and download the video (202)
+    """
+    data = request.json
+
+    try:
+        audio_url, image_urls, settings = parse_convert_request(data)
+        job_id, _ = submit_render_job(audio_url, image_urls, settings)
+    except RenderError as e:
+        return render_error_response(e)
+    job = read_json(job_record_path(job_id)) or {}
+    return jsonify({
+        "job_id": job_id,
+        "status": job.get('status', 'queued'),
+        "status_url": f"/jobs/{job_id}",
+        "download_url": f"/jobs/{job_id}/download",
+    }), 202
+
+
+# Route to get the status of a render job
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    API endpoint to get the state of a render job.
+    
+    Returns:
+        JSON with status (queued, running, done, failed), stage, progress (0-100)
+        and, once finished, filename or error
+    """
+    path = job_record_path(job_id)
+    job = read_json(path) if path else None
+    if not job:
+        return jsonify({"error": f"Job '{job_id}' not found."}), 404
+    return jsonify(job_state(job)), 200
+
+
+# Route to download the video of a finished render job
+@app.route('/jobs/<job_id>/download', methods=['GET'])
+def download_job(job_id):
+    """
+    API endpoint to download the video of a finished render job.
+    
+    Returns:
+        MP4 video file, or JSON error message if the job is unknown or not done yet
+    """
+    path = job_record_path(job_id)
+    job = read_json(path) if path else None
+    if not job:
+        return jsonify({"error": f"Job '{job_id}' not found."}), 404
+    job = job_state(job)
+    if job['status'] == 'failed':
+        return jsonify({"error": job.get('error')}), job.get('status_code', 500)
+    if job['status'] != 'done':
+        return jsonify({"error": "Video is not ready yet.", "status": job['status']}), 409
+
+    video_path = os.path.join(VIDEO_FOLDER, job['filename'])
+    if not os.path.isfile(video_path):
+        return jsonify({"error": f"Video file '{job['filename']}' not found."}), 404
+    return send_file(video_path, as_attachment=True)
 
 
 # Route to delete video by filename
@@ -345,6 +2578,46 @@ def delete_video():
             "message": f"Failed to delete video file: {str(e)}"
         }), 500
 
+# Function to parse the output format options of a resize request
+def parse_resize_format(fmt, quality):
+    """
+    Validate the fmt and q options of /resize-image and /resize-images.
+
+    Returns:
+        tuple: (candidate formats, quality, error message or None)
+    """
+    formats = None
+    # fmt comes from the query string or, for /resize-images, from any JSON value
+    if fmt is None or isinstance(fmt, str):
+        formats = negotiate_formats((fmt or 'auto').lower(), request.accept_mimetypes)
+    if not formats:
+        return None, None, f"Unsupported format. Available: auto, {', '.join(RESIZE_FORMATS)}"
+    if quality is None:
+        return formats, RESIZE_QUALITY, None
+    try:
+        quality = int(quality)
+    except (TypeError, ValueError):
+        quality = 0
+    if not 1 <= quality <= 95:
+        return None, None, "Quality must be an integer between 1 and 95."
+    return formats, quality, None
+
+# Function to validate the target sizes of /resize-image and /resize-images
+def check_resize_sizes(sizes):
+    """
+    Check that every (width, height) is positive and within RESIZE_MAX_OUTPUT_PIXELS,
+    before anything is downloaded or allocated.
+
+    Returns:
+        str: Error message, or None if all sizes are valid
+    """
+    if any(w <= 0 or h <= 0 for w, h in sizes):
+        return "Width and height must be positive."
+    if any(w * h > RESIZE_MAX_OUTPUT_PIXELS for w, h in sizes):
+        return f"Width x height must be at most {RESIZE_MAX_OUTPUT_PIXELS} pixels."
+    return None
+
+
 # make router get resize-image
 @app.route('/resize-image', methods=['GET'])
 def resize_image():
@@ -352,15 +2625,19 @@ def resize_image():
     API endpoint to resize an image to exact dimensions.
 
     Query parameters:
+    - url: The URL of the source image
     - w: The target width (in pixels)
     - h: The target height (in pixels)
+    - fmt: Output format, jpeg, png, webp or auto (default: auto, the smallest format the client accepts)
+    - q: Quality of lossy formats, 1-95 (default: RESIZE_QUALITY)
 
     Returns:
-        JSON response with status message
+        The resized image, or JSON response with status message on failure
     """
     width = request.args.get('w', type=int)
     height = request.args.get('h', type=int)
     url = request.args.get('url', type=str)
+    fmt = request.args.get('fmt', type=str)
 
     # Validate required parameters
     if not width or not height or not url:
@@ -368,14 +2645,165 @@ def resize_image():
             "status": "error",
             "message": "Both width and height are required."
         }), 400
+    error = check_resize_sizes([(width, height)])
+    if error:
+        return jsonify({
+            "status": "error",
+            "message": error
+        }), 400
+    formats, quality, error = parse_resize_format(fmt, request.args.get('q'))
+    if error:
+        return jsonify({
+            "status": "error",
+            "message": error
+        }), 400
 
-    result = resize_image_exact(url, width, height)
+    cache_key = resize_cache_key(url, width, height, ','.join(formats), quality)
+    result = get_cached_resized(cache_key)
     if not result:
+        try:
+            result = resize_image_exact(url, width, height, formats, quality)
+        except ImageTooLargeError as e:
+            return jsonify({
+                "status": "error",
+                "message": f"Image is too large: {e}"
+            }), 413
+        except UnidentifiedImageError:
+            return jsonify({
+                "status": "error",
+                "message": "The url does not point to a supported image."
+            }), 400
+        if not result:
+            return jsonify({
+                "status": "error",
+                "message": "Failed to resize image."
+            }), 500
+        result = store_resized(cache_key, *result)
+
+    # Stream the image from memory, nothing is written to the working directory
+    # conditional=True answers If-None-Match requests matching the ETag with 304
+    data, mimetype, etag = result
+    response = send_file(
+        BytesIO(data),
+        mimetype=mimetype,
+        etag=etag,
+        max_age=RESIZE_CACHE_MAX_AGE,
+        conditional=True
+    )
+    # With fmt=auto the format depends on the Accept header, shared caches must key on it
+    if len(formats) > 1:
+        response.vary.add('Accept')
+    return response
+
+# make router post resize-images
+@app.route('/resize-images', methods=['POST'])
+def resize_images():
+    """
+    API endpoint to resize one image to several exact dimensions.
+    The source is downloaded and decoded once for all sizes.
+
+    Expected JSON payload:
+    {
+        "url": "http://example.com/image.jpg",
+        "sizes": [{"w": 320, "h": 240}, {"w": 1280, "h": 720}],
+        "fmt": "auto",  // Optional, as for /resize-image
+        "q": 82  // Optional, as for /resize-image
+    }
+
+    Returns:
+        JSON manifest with one /resize-image URL per size, served from the cache
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
         return jsonify({
             "status": "error",
-            "message": "Failed to resize image."
-        }), 500
-    return send_file(result)
+            "message": "The request body must be a JSON object."
+        }), 400
+    url = data.get('url')
+    sizes = data.get('sizes')
+
+    # Validate required parameters
+    if not url or not isinstance(url, str) or not isinstance(sizes, list) or not sizes:
+        return jsonify({
+            "status": "error",
+            "message": "url and a non-empty list of sizes are required."
+        }), 400
+    if len(sizes) > RESIZE_BATCH_MAX_SIZES:
+        return jsonify({
+            "status": "error",
+            "message": f"At most {RESIZE_BATCH_MAX_SIZES} sizes are allowed."
+        }), 400
+    try:
+        sizes = [(int(size['w']), int(size['h'])) for size in sizes]
+    except (TypeError, KeyError, ValueError):
+        return jsonify({
+            "status": "error",
+            "message": "Each size needs an integer w and h."
+        }), 400
+    error = check_resize_sizes(sizes)
+    if error:
+        return jsonify({
+            "status": "error",
+            "message": error
+        }), 400
+    fmt, q = data.get('fmt'), data.get('q')
+    formats, quality, error = parse_resize_format(fmt, q)
+    if error:
+        return jsonify({
+            "status": "error",
+            "message": error
+        }), 400
+
+    # Only the sizes missing from the cache are produced
+    format_key = ','.join(formats)
+    results = [get_cached_resized(resize_cache_key(url, w, h, format_key, quality)) for w, h in sizes]
+    missing = sorted({size for size, result in zip(sizes, results) if not result})
+    if missing:
+        try:
+            variants = resize_image_variants(url, missing, formats, quality)
+        except ImageTooLargeError as e:
+            return jsonify({
+                "status": "error",
+                "message": f"Image is too large: {e}"
+            }), 413
+        except UnidentifiedImageError:
+            return jsonify({
+                "status": "error",
+                "message": "The url does not point to a supported image."
+            }), 400
+        if not variants:
+            return jsonify({
+                "status": "error",
+                "message": "Failed to resize image."
+            }), 500
+        produced = {
+            size: store_resized(resize_cache_key(url, *size, format_key, quality), *variant)
+            for size, variant in zip(missing, variants)
+        }
+        results = [result or produced[size] for size, result in zip(sizes, results)]
+
+    # The manifest URLs name the format that was chosen, so they don't depend on
+    # the Accept header of whoever fetches them, and the variants are also stored
+    # under that single-format key for /resize-image to find
+    images = []
+    for (w, h), (image_data, mimetype, etag) in zip(sizes, results):
+        chosen = RESIZE_MIMETYPE_FORMATS[mimetype]
+        chosen_key = resize_cache_key(url, w, h, chosen, quality)
+        if not get_cached_resized(chosen_key):
+            store_resized(chosen_key, image_data, mimetype)
+        images.append({
+            "w": w,
+            "h": h,
+            "url": url_for('resize_image', url=url, w=w, h=h, fmt=chosen, q=quality, _external=True),
+            "mimetype": mimetype,
+            "size": len(image_data),
+            "etag": etag
+        })
+
+    return jsonify({
+        "status": "success",
+        "images": images
+    })
 
 # Run the Flask application
 if __name__ == '__main__':